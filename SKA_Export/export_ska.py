@@ -1,6 +1,7 @@
 import struct
 import os
 import bpy
+import numpy as np
 import mathutils    
 from bpy_extras import io_utils, node_shader_utils
 import time
@@ -9,7 +10,7 @@ from bpy_extras.wm_utils.progress_report import (
     ProgressReportSubstep,
 )
 
-from .ska import FixedLengthName, SkmFile, SkmBone, SkmMaterial, SkaFile, SkaBone, MdfFile, SkmVertex, SkmFace
+from .ska import FixedLengthName, SkmFile, SkmBone, SkmMaterial, SkaFile, SkaBone, MdfFile
 
 progress = None
 
@@ -95,42 +96,39 @@ def blender_to_skm(mesh, rig, WRITE_MDF):
 
         vertex_count = len(bmesh.vertices)
         face_count   = len(bmesh.polygons)
+        loop_count   = len(bmesh.loops)
 
         print("%d vertices, %d faces" % (vertex_count, face_count))
 
-        # Create vertices
-        for vtx in bmesh.vertices:
-            skm_vtx = SkmVertex()
-            skm_vtx.pos = vtx.co.to_tuple() + (0.0,)
-            skm_vtx.normal = vtx.normal.to_tuple() + (0.0,)
-            skm_data.vertex_data.append(skm_vtx)
-        assert len(skm_data.vertex_data) == vertex_count
-
-        # Create faces (Triangles). Note: face should be triangles only!
-        for p in bmesh.polygons:
-            loop_start = p.loop_start
-            loop_total = p.loop_total
-            assert loop_total == 3, "Faces must be triangles!"
-            face = bmesh.loops[loop_start+0].vertex_index, bmesh.loops[loop_start+1].vertex_index, bmesh.loops[loop_start+2].vertex_index
-            skm_face = SkmFace()
-            skm_face.vertex_ids = face
-            skm_data.face_data.append(skm_face)
-        assert len(skm_data.face_data) == face_count
+        # Vertices
+        pos = np.empty(vertex_count * 3, np.float32)
+        bmesh.vertices.foreach_get("co", pos)
+        normal = np.empty(vertex_count * 3, np.float32)
+        bmesh.vertices.foreach_get("normal", normal)
+
+        # Faces (Triangles). Note: face should be triangles only!
+        loop_total = np.empty(face_count, np.int32)
+        bmesh.polygons.foreach_get("loop_total", loop_total)
+        assert (loop_total == 3).all(), "Faces must be triangles!"
+        loop_start = np.empty(face_count, np.int32)
+        bmesh.polygons.foreach_get("loop_start", loop_start)
+        material_ids = np.empty(face_count, np.int32)
+        bmesh.polygons.foreach_get("material_index", material_ids)
+        loop_vertex_ids = np.empty(loop_count, np.int32)
+        bmesh.loops.foreach_get("vertex_index", loop_vertex_ids)
+        face_loops = loop_start[:, None] + np.arange(3)
+        vertex_ids = loop_vertex_ids[face_loops]
 
-        
         # Get UV coordinates for each polygon's vertices
         print("Setting UVs")
-        uvl = bmesh.uv_layers[0].data[:]
-        for fidx, fa in enumerate(skm_data.face_data):
-            fa.material_id = bmesh.polygons[fidx].material_index
-
-        for fidx, pl in enumerate(bmesh.polygons):
-            face = skm_data.face_data[fidx]
-            v1, v2, v3 = face.vertex_ids
-
-            skm_data.vertex_data[v1].uv = uvl[pl.loop_start + 0].uv
-            skm_data.vertex_data[v2].uv = uvl[pl.loop_start + 1].uv 
-            skm_data.vertex_data[v3].uv = uvl[pl.loop_start + 2].uv
+        loop_uv = np.empty(loop_count * 2, np.float32)
+        bmesh.uv_layers[0].data.foreach_get("uv", loop_uv)
+        loop_uv = loop_uv.reshape(loop_count, 2)
+        uv = np.zeros((vertex_count, 2), np.float32)
+        uv[vertex_ids.ravel()] = loop_uv[face_loops.ravel()]
+
+        skm_data.set_vertex_arrays(pos.reshape(vertex_count, 3), normal.reshape(vertex_count, 3), uv)
+        skm_data.set_face_arrays(vertex_ids, material_ids)
         
     def rig_to_skm_bones(skm_data):
         '''
@@ -169,14 +167,18 @@ def blender_to_skm(mesh, rig, WRITE_MDF):
         if bpy.ops.object.mode_set.poll():
             bpy.ops.object.mode_set(mode='OBJECT')
         
+        vertex_count = len(obj.data.vertices)
+        attachment_count = np.zeros(vertex_count, np.int16)
+        attachment_bones = np.zeros((vertex_count, 6), np.int16)
+        attachment_weights = np.zeros((vertex_count, 6), np.float32)
         for vidx, vtx in enumerate(obj.data.vertices):
-            for i, vg in enumerate(vtx.groups):
-                bone_id = vg.group
-                bone_wt = vg.weight
-                skm_data.vertex_data[vidx].attachment_bones.append(bone_id)
-                skm_data.vertex_data[vidx].attachment_weights.append(bone_wt)
-            if skm_data.vertex_data[vidx].attachment_count > 6:
+            if len(vtx.groups) > 6:
                 raise Exception(f"Too many bone attachments for vertex {vidx}! Max is 6")
+            for i, vg in enumerate(vtx.groups):
+                attachment_bones[vidx, i] = vg.group
+                attachment_weights[vidx, i] = vg.weight
+            attachment_count[vidx] = len(vtx.groups)
+        skm_data.set_vertex_attachments(attachment_bones, attachment_weights, attachment_count)
         
         return
     
@@ -296,7 +298,7 @@ def _write_ska(context, filepath,
     """
     print("\n*** Exporting SKA ***")
     # Time the export
-    time1 = time.clock()
+    time1 = time.perf_counter()
     # Blender.Window.WaitCursor(1)
     
     if global_matrix is None:
@@ -343,7 +345,7 @@ def _write_ska(context, filepath,
 
     # Debugging only: report the exporting time:
     # Blender.Window.WaitCursor(0)
-    print("SKA export time: %.2f" % (time.clock() - time1))
+    print("SKA export time: %.2f" % (time.perf_counter() - time1))
     return
 
 def blender_save_ska(operator, context, filepath="", use_selection=True, global_matrix=None,):
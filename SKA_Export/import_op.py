@@ -66,6 +66,12 @@ class ImportSKA(bpy.types.Operator, ImportHelper):
             description="Ignores all keyframes (only uses the stuff in SKA bone)",
             default=True,
             )
+    anim_filter: StringProperty(
+            name="Animations",
+            description="Only import the animations matching these comma-separated "
+                        "name patterns, e.g. unarmed_unarmed_* (empty for all)",
+            default="",
+            )
     def execute(self, context):
         from . import import_ska
 
@@ -168,6 +174,7 @@ class SKA_PT_import_options(bpy.types.Panel):
         operator = sfile.active_operator
 
         layout.prop(operator, "apply_animations")
+        layout.prop(operator, "anim_filter")
         layout.prop(operator, "axis_forward")
         layout.prop(operator, "axis_up")
 
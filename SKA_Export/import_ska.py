@@ -7,7 +7,8 @@ import mathutils
 from mathutils import Vector, Quaternion
 
 from SKA_Export.ska import SkaAnimStream
-from .ska import SkmFile, SkaFile, MdfFile
+from .ska import SkmFile, SkaFile, MdfFile, DECODE_CHANNELS
+from .skeleton import get_skeleton
 from bpy_extras.wm_utils.progress_report import ProgressReport
 from bpy_extras import node_shader_utils
 
@@ -314,7 +315,7 @@ class RestBoneState:
 
 
 def ska_to_blender(ska_data, skm_data, importedObjects, USE_INHERIT_ROTATION, USE_LOCAL_LOCATION,
-                   APPLY_ANIMATIONS):
+                   APPLY_ANIMATIONS, ANIM_FILTER=""):
     print("Importing animations")
     contextObName = "ToEE Model"
     ska_rig_name = "SKA Rig"
@@ -344,23 +345,22 @@ def ska_to_blender(ska_data, skm_data, importedObjects, USE_INHERIT_ROTATION, US
     ska_to_skm_bone_mapping = ska_data.get_ska_to_skm_bone_map(skm_data)
 
     # State (loc, rot, sca) for each of the bones in rest position, relative to parent
+    skeleton = get_skeleton(skm_data)
     bone_rest_state = dict()
     for ska_bone_id, skm_bone_id in ska_to_skm_bone_mapping.items():
-        skm_bone = skm_data.bone_data[skm_bone_id]
         ska_bone = ska_data.bone_data[ska_bone_id]
-        
-        rest_world = mathutils.Matrix(skm_bone.world_inverse_matrix).inverted()
+
         if ska_bone.parent_id == -1:
-            # rest_world = mathutils.Matrix(skm_data.bone_data[0].world_inverse_matrix) @ rest_world
-            # rest_world = mathutils.Matrix(skm_data.bone_data[0].world_inverse_matrix)
-            pass
-        elif ska_bone.parent_id != -1:
-            rest_world = mathutils.Matrix(skm_data.bone_data[skm_bone.parent_id].world_inverse_matrix) @ rest_world
-        rest_loc, rest_rot, rest_sca = rest_world.decompose()
+            rest_world = skeleton.bind[skm_bone_id]
+        else:
+            rest_world = skeleton.local_rest[skm_bone_id]
+        rest_loc, rest_rot, rest_sca = mathutils.Matrix(rest_world.tolist()).decompose()
         bone_rest_state[ska_bone_id] = RestBoneState(rest_loc, rest_rot, rest_sca)
 
-    anim_count = len(ska_data.animation_data)
-    anim_count = 10  # DEBUG
+    # only the selected animations' streams get decoded (ska_data is read lazily)
+    anim_indices = ska_data.find_animations(ANIM_FILTER)
+    anim_count = len(anim_indices)
+    print("%d of %d animations selected" % (anim_count, len(ska_data.animation_data)))
     rig.animation_data_create()
     bpy.ops.object.mode_set(mode='POSE')
     bpy.ops.poselib.pose_add(frame=0, name = 'T Pose')
@@ -381,8 +381,8 @@ def ska_to_blender(ska_data, skm_data, importedObjects, USE_INHERIT_ROTATION, US
     bpy.ops.poselib.pose_add(frame=1, name = 'Rest Pose')
     
     progress.enter_substeps(anim_count, "Generating animation F-Curves (%d)..." % anim_count)
-    for i in range(0, anim_count):
-        progress.step(i)
+    for i in anim_indices:
+        progress.step()
         ad = ska_data.animation_data[i]
         anim_header = ad.header
         action_name = str(anim_header.name)
@@ -418,11 +418,8 @@ def ska_to_blender(ska_data, skm_data, importedObjects, USE_INHERIT_ROTATION, US
                         print('Non-unity scaling:', bone_idx, ska_data.bone_data[bone_idx].name,frame, scaling)
                 pass
 
-            raw_frames = stream.raw_frames
-            
             for bone_idx, keyframes in stream.rotation_channels.items():
                 skm_bone_idx = ska_to_skm_bone_mapping[bone_idx]
-                skm_bone = skm_data.bone_data[skm_bone_idx]
                 # print("Skm bone idx: %d" % skm_bone_idx)
                 # rest_pose = bone_rest_state[skm_bone_idx]
                 rest_pose = bone_rest_state[bone_idx]
@@ -458,7 +455,6 @@ def ska_to_blender(ska_data, skm_data, importedObjects, USE_INHERIT_ROTATION, US
 
             for bone_idx, keyframes in stream.location_channels.items():
                 skm_bone_idx = ska_to_skm_bone_mapping[bone_idx]
-                skm_bone = skm_data.bone_data[skm_bone_idx]
                 # rest_pose = bone_rest_state[skm_bone_idx]
                 rest_pose = bone_rest_state[bone_idx]
 
@@ -508,7 +504,7 @@ def get_skm_filepath(ska_filepath):
 
 def load_skm(filepath, context, IMAGE_SEARCH=True):
     global SCN, ToEE_data_dir, progress
-    time1 = time.clock()  # for timing the import duration
+    time1 = time.perf_counter()  # for timing the import duration
     with ProgressReport(context.window_manager) as progress:
 
         print("importing SKA: %r..." % (filepath), end="")
@@ -554,7 +550,7 @@ def load_skm(filepath, context, IMAGE_SEARCH=True):
         object_dictionary.clear()
         object_matrix.clear()
         
-    print(" done in %.4f sec." % (time.clock() - time1))
+    print(" done in %.4f sec." % (time.perf_counter() - time1))
     return
 
 
@@ -564,13 +560,18 @@ def load_ska_and_skm(filepath, context, IMPORT_CONSTRAIN_BOUNDS=10.0,
              USE_INHERIT_ROTATION=True,
              USE_LOCAL_LOCATION=True,
              APPLY_ANIMATIONS=False,
+             ANIM_FILTER="",
              global_matrix=None):
+    '''
+    ANIM_FILTER - comma-separated glob patterns of the animations to import,
+    case-insensitive (e.g. "unarmed_unarmed_*"); empty for all of them
+    '''
     global SCN, ToEE_data_dir, progress
 
     # XXX
     # 	if BPyMessages.Error_NoFile(filepath):
     # 		return
-    time1 = time.clock()  # for timing the import duration
+    time1 = time.perf_counter()  # for timing the import duration
     # progress = ProgressReport(context.window_manager)
     with ProgressReport(context.window_manager) as progress:
         
@@ -606,7 +607,7 @@ def load_ska_and_skm(filepath, context, IMPORT_CONSTRAIN_BOUNDS=10.0,
         with open(ska_filepath, 'rb') as file:
             print('Opened file: ', ska_filepath)
             if APPLY_ANIMATIONS:
-                ska_data.read(file)
+                ska_data.read(file, lazy=True, decode_mode=DECODE_CHANNELS)
 
         # fixme, make unglobal, clear in case
         object_dictionary.clear()
@@ -646,8 +647,12 @@ def load_ska_and_skm(filepath, context, IMPORT_CONSTRAIN_BOUNDS=10.0,
 
         progress.enter_substeps(1, "Converting SKA to Blender animations...")
         if APPLY_ANIMATIONS:
-            ska_to_blender(ska_data, skm_data, importedObjects, USE_INHERIT_ROTATION, USE_LOCAL_LOCATION,
-                        APPLY_ANIMATIONS)
+            try:
+                ska_to_blender(ska_data, skm_data, importedObjects, USE_INHERIT_ROTATION, USE_LOCAL_LOCATION,
+                            APPLY_ANIMATIONS, ANIM_FILTER)
+            finally:
+                # the lazily read file buffer is held until now
+                ska_data.close()
         
         # fixme, make unglobal
         object_dictionary.clear()
@@ -657,7 +662,7 @@ def load_ska_and_skm(filepath, context, IMPORT_CONSTRAIN_BOUNDS=10.0,
         view_layer.update()
         
     # Select all new objects.
-    print(" done in %.4f sec." % (time.clock() - time1))
+    print(" done in %.4f sec." % (time.perf_counter() - time1))
 
 
 def blender_load_ska(operator, context, filepath="",
@@ -667,6 +672,7 @@ def blender_load_ska(operator, context, filepath="",
          use_inherit_rot=True,
          use_local_location=True,
          apply_animations=True,
+         anim_filter="",
          global_matrix=None,
          ):
     load_ska_and_skm(filepath, context, IMPORT_CONSTRAIN_BOUNDS=constrain_size,
@@ -675,6 +681,7 @@ def blender_load_ska(operator, context, filepath="",
              USE_INHERIT_ROTATION=use_inherit_rot,
              USE_LOCAL_LOCATION=use_local_location,
              APPLY_ANIMATIONS=apply_animations,
+             ANIM_FILTER=anim_filter,
              global_matrix=global_matrix,
              )
 
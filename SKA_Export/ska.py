@@ -1,8 +1,18 @@
+import fnmatch
+import hashlib
+import mmap
 import struct
+import sys
+import os
 import time
-from io import BytesIO
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from types import MappingProxyType
 from typing import List
 
+import numpy as np
+
 def write_byte(file, data):
     file.write( struct.pack("<b", data))
 
@@ -21,10 +31,37 @@ def write_short_list(file, data):
 def write_float_list(file, data):
     file.write( struct.pack("<%df" % len(data), *data))
 
+def open_file_buffer(file, use_mmap=False):
+    '''
+    Returns (mapping, buffer) for an open binary file. The buffer is a memoryview,
+    so slicing it doesn't copy. With use_mmap it views a read-only memory mapping
+    of the file and only the pages actually touched get loaded; otherwise the
+    file is read into memory and mapping is None.
+    '''
+    if use_mmap:
+        mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return mapping, memoryview(mapping)
+    return None, memoryview(file.read())
+
+def close_file_buffer(mapping, buffer):
+    if isinstance(buffer, memoryview):
+        buffer.release()
+    if mapping is not None:
+        mapping.close()
+
 def matrix4_to_3x4_array(mat):
     """Concatenate matrix's columns into a single, flat tuple"""
     return tuple(f for v in mat[0:3] for f in v)
 
+def encode_fixed_name(name, size):
+    '''
+    Encodes a name for a fixed-size field, which needs room for its NUL terminator
+    '''
+    b_name = str(name).encode()
+    if len(b_name) >= size:
+        raise Exception("FixedLengthName: %s is too long (max. %d bytes)" % (name, size - 1))
+    return b_name
+
 class FixedLengthName(object):
     __slots__ = "name", "size"
 
@@ -37,24 +74,176 @@ class FixedLengthName(object):
         assert len(self.name) <= Size, "FixedLengthName: must be shorter than Size (%d)!" % Size
 
     def from_raw_data(self, rawdata):
-        self.name = rawdata.split(b'\0')[0].decode()
+        self.name = bytes(rawdata).split(b'\0', 1)[0].decode()
 
     def get_size(self):
         return self.size
 
+    def encode(self):
+        return encode_fixed_name(self.name, self.size)
+
     def write(self, file):
-        
-        b_name = bytes(self.name.encode() )
-        name_len = len(b_name)
-        file.write(b_name)
-        for p in range(0, self.size - name_len):
-            file.write(b'\0')
+        file.write(self.encode().ljust(self.size, b'\0'))
+
+    def pack_into(self, buf, offset):
+        b_name = self.encode()
+        buf[offset:offset + len(b_name)] = b_name
+        buf[offset + len(b_name):offset + self.size] = bytes(self.size - len(b_name))
 
     def __str__(self):
         return str(self.name)
 
 
+class RecordSchema(object):
+    '''
+    Layout of a fixed-size, little-endian binary record, described once as a list of
+    (field name, struct type code[, shape]), e.g. ("pos", "f", 4), ("name", "48s"),
+    ("world_inverse", "f", (3, 4)). A RecordSchema can be used as the type code of a
+    field to nest records.
+
+    struct - precompiled struct.Struct for the whole record (array fields flattened)
+    dtype - NumPy structured dtype with the same layout, for whole tables at once
+    size - record size in bytes
+    offsets - field name: offset in bytes
+    '''
+    __slots__ = "fields", "struct", "dtype", "size", "offsets", "_field_structs", "_field_slices"
+
+    def __init__(self, fields):
+        self.fields = []
+        self.offsets = dict()
+        self._field_structs = dict()  # name: (struct, scalar)
+        self._field_slices = []  # per field: (first value, end value, scalar)
+        formats = []
+        dtype_fields = []
+        value_count = 0
+        for field in fields:
+            name, type_code = field[0], field[1]
+            shape = field[2] if len(field) > 2 else ()
+            if isinstance(shape, int):
+                shape = (shape,)
+            count = 1
+            for dim in shape:
+                count *= dim
+
+            if isinstance(type_code, RecordSchema):
+                field_format = type_code.struct.format.lstrip("<") * count
+                field_dtype = type_code.dtype
+                field_values = len(type_code.fields) * count
+                scalar = False
+            else:
+                field_format = "%d%s" % (count, type_code) if shape else type_code
+                if type_code.endswith("s"):
+                    field_format = type_code * count
+                    field_dtype = "S" + type_code[:-1]
+                else:
+                    field_dtype = "<" + type_code
+                field_values = count
+                scalar = not shape
+
+            self.fields.append((name, type_code, shape))
+            self.offsets[name] = struct.calcsize("<" + "".join(formats))
+            self._field_structs[name] = (struct.Struct("<" + field_format), scalar)
+            self._field_slices.append((value_count, value_count + field_values, scalar))
+            value_count += field_values
+            formats.append(field_format)
+            dtype_fields.append((name, field_dtype, shape) if shape else (name, field_dtype))
+
+        self.struct = struct.Struct("<" + "".join(formats))
+        self.dtype = np.dtype(dtype_fields)
+        self.size = self.struct.size
+        assert self.dtype.itemsize == self.size, "RecordSchema: struct and dtype sizes differ"
+
+    # single records
+    def unpack_from(self, buf, offset=0):
+        '''
+        Returns the record's values in field order, arrays flattened
+        '''
+        return self.struct.unpack_from(buf, offset)
+
+    def unpack_fields(self, buf, offset=0):
+        '''
+        Returns a list with one entry per field: a value, or a flat tuple for array fields
+        '''
+        values = self.struct.unpack_from(buf, offset)
+        return [values[start] if scalar else values[start:end] for start, end, scalar in self._field_slices]
+
+    def pack_into(self, buf, offset, *values):
+        self.struct.pack_into(buf, offset, *values)
+
+    def pack_fields(self, *field_values):
+        '''
+        Packs one value (or flat sequence, for array fields) per field
+        '''
+        values = []
+        for value, (_, _, scalar) in zip(field_values, self._field_slices):
+            if scalar:
+                values.append(value)
+            else:
+                values.extend(value)
+        return self.struct.pack(*values)
+
+    def get(self, buf, name, offset=0):
+        '''
+        Reads one field of the record at offset; array fields come back as a flat tuple
+        '''
+        field_struct, scalar = self._field_structs[name]
+        values = field_struct.unpack_from(buf, offset + self.offsets[name])
+        return values[0] if scalar else values
+
+    def set(self, buf, name, value, offset=0):
+        '''
+        Writes one field of the record at offset
+        '''
+        field_struct, scalar = self._field_structs[name]
+        if scalar:
+            field_struct.pack_into(buf, offset + self.offsets[name], value)
+        else:
+            field_struct.pack_into(buf, offset + self.offsets[name], *value)
+
+    # tables
+    def frombuffer(self, buf, count, offset=0):
+        '''
+        Structured array view of count records starting at offset (no copy)
+        '''
+        return np.frombuffer(buf, dtype=self.dtype, count=count, offset=offset)
+
+    def zeros(self, count):
+        return np.zeros(count, dtype=self.dtype)
+
+
+SKM_FILE_HEADER_SCHEMA = RecordSchema([
+    ("bone_count", "i"),
+    ("bone_offset", "i"),
+    ("material_count", "i"),
+    ("material_offset", "i"),
+    ("vertex_count", "i"),
+    ("vertex_offset", "i"),
+    ("face_count", "i"),
+    ("face_offset", "i"),
+    ("unk", "i", 2),
+])
+
+SKA_FILE_HEADER_SCHEMA = RecordSchema([
+    ("bone_count", "i"),
+    ("bone_offset", "i"),
+    ("variation_count", "i"),
+    ("variation_offset", "i"),
+    ("anim_count", "i"),
+    ("anim_offset", "i"),
+])
+
 ########## SKM structs
+SKM_VERTEX_SCHEMA = RecordSchema([
+    ("pos", "f", 4),
+    ("normal", "f", 4),
+    ("uv", "f", 2),
+    ("pad", "h"),
+    ("attachment_count", "h"),
+    ("attachment_bones", "h", 6),
+    ("attachment_weights", "f", 6),
+])
+SKM_VERTEX_DTYPE = SKM_VERTEX_SCHEMA.dtype
+
 class SkmVertex(object):
     __slots__ = "pos", "normal", "uv", "attachment_bones", "attachment_weights"
     pos: List[float]
@@ -75,36 +264,40 @@ class SkmVertex(object):
         return len(self.attachment_bones)
 
     def from_raw_data(self, rawdata):
-        self.pos = struct.unpack('<4f', rawdata[0:0 + 16])
-        self.normal = struct.unpack('<4f', rawdata[0 + 16:0 + 32])
-        self.uv = struct.unpack('<2f', rawdata[0 + 32:0 + 40])
-        dummy = struct.unpack('<h', rawdata[40:42])[0]
+        (self.pos, self.normal, self.uv, dummy, attachment_count,
+         bones, weights) = SKM_VERTEX_SCHEMA.unpack_fields(rawdata)
         # if dummy != 0:
             # print('sheeit')
-        attachment_count = struct.unpack('<h', rawdata[42:44])[0]
         if attachment_count > 6:
             raise Exception("SkmVertex: Unexcepted number of attachments read!")
         attachment_count = max(0, min(attachment_count, 6))
-        self.attachment_bones = []
-        self.attachment_bones = struct.unpack("<%dh" % attachment_count, rawdata[44:44 + attachment_count * 2])
-        self.attachment_weights = struct.unpack("<%df" % attachment_count,
-                                                rawdata[44 + 12:44 + 12 + attachment_count * 4])
+        self.attachment_bones = bones[:attachment_count]
+        self.attachment_weights = weights[:attachment_count]
 
     def write(self, file):
-        write_float_list(file, self.pos)
-        write_float_list(file, self.normal)
-        write_float_list(file, self.uv)
-        
-        file.write( struct.pack('<h', 0) )
-        file.write( struct.pack('<h', self.attachment_count) )
-
-        write_short_list( file, [*self.attachment_bones,] + [0 for _ in range(self.attachment_count, 6)] )
-        write_float_list( file, [*self.attachment_weights,] + [0.0 for _ in range(self.attachment_count, 6)] )
+        buf = bytearray(self.get_size())
+        self.pack_into(buf, 0)
+        file.write(buf)
         return
 
+    def pack_into(self, buf, offset):
+        padding = _ZEROS[self.attachment_count:]
+        SKM_VERTEX_SCHEMA.pack_into(buf, offset, *self.pos, *self.normal, *self.uv, 0, self.attachment_count,
+                                     *self.attachment_bones, *padding, *self.attachment_weights, *padding)
+
     @staticmethod
     def get_size():
-        return 80
+        return SKM_VERTEX_SCHEMA.size
+
+_ZEROS = (0,) * 6
+
+SKM_BONE_SCHEMA = RecordSchema([
+    ("flags", "h"),
+    ("parent_id", "h"),
+    ("name", "48s"),
+    ("world_inverse", "f", (3, 4)),
+])
+SKM_BONE_DTYPE = SKM_BONE_SCHEMA.dtype
 
 class SkmBone:
     def __init__(self, Name="", Parent_id=0):
@@ -119,30 +312,36 @@ class SkmBone:
         return self.world_inverse + [[0, 0, 0, 1]]
 
     def from_raw_data(self, rawdata):
-        self.flags = struct.unpack('<h', rawdata[0:2])[0]
-        self.parent_id = struct.unpack('<h', rawdata[2:4])[0]
-        self.name.from_raw_data(rawdata[4:52])
-        tmp = struct.unpack('<12f', rawdata[52:52 + 48])
-        self.world_inverse = [tmp[i * 4:(i + 1) * 4] for i in range(0, 3)] 
+        self.flags, self.parent_id, name, world_inverse = SKM_BONE_SCHEMA.unpack_fields(rawdata)
+        self.name.from_raw_data(name)
         # [ [t0...t3],
         #   [t4...t7],
         #   [t8..t11] ]
+        self.world_inverse = [list(world_inverse[i:i + 4]) for i in range(0, 12, 4)]
         return
 
     def write(self, file):
-        write_short(file, self.flags) 
-        write_short(file, self.parent_id)
-        self.name.write(file)
-        for i in range(0, 3):
-            write_float_list(file, self.world_inverse[i])
+        buf = bytearray(self.get_size())
+        self.pack_into(buf, 0)
+        file.write(buf)
+
+    def pack_into(self, buf, offset):
+        # world_inverse may be nested 3x4 or flattened
+        world_inverse = np.asarray(self.world_inverse, dtype=np.float32).ravel()
+        SKM_BONE_SCHEMA.pack_into(buf, offset, self.flags, self.parent_id, self.name.encode(), *world_inverse.tolist())
 
     @staticmethod
     def get_size():
-        return 100
+        return SKM_BONE_SCHEMA.size
 
     def __str__(self):
         return self.name.__str__()
 
+SKM_MATERIAL_SCHEMA = RecordSchema([
+    ("id", "128s"),
+])
+SKM_MATERIAL_DTYPE = SKM_MATERIAL_SCHEMA.dtype
+
 class SkmMaterial(object):
     '''
     id - path relative to ToEE data dir
@@ -158,9 +357,13 @@ class SkmMaterial(object):
 
     def write(self, file):
         self.id.write(file)
+
+    def pack_into(self, buf, offset):
+        self.id.pack_into(buf, offset)
+
     @staticmethod
     def get_size():
-        return 128
+        return SKM_MATERIAL_SCHEMA.size
 
 class MdfFile(object):
     __slots__ = ['texture_filepath']
@@ -188,24 +391,42 @@ class MdfFile(object):
         file.write("\"\n")
         return
     
+SKM_FACE_SCHEMA = RecordSchema([
+    ("material_id", "h"),
+    ("vertex_ids", "h", 3),
+])
+SKM_FACE_DTYPE = SKM_FACE_SCHEMA.dtype
+
 class SkmFace(object):
     __slots__ = "material_id", "vertex_ids"
     material_id: int
     vertex_ids: List[int]
     def from_raw_data(self, rawdata):
-        self.material_id = struct.unpack('<h', rawdata[0:2])[0]
-        self.vertex_ids = struct.unpack('<3h', rawdata[2:8])
+        self.material_id, self.vertex_ids = SKM_FACE_SCHEMA.unpack_fields(rawdata)
 
     def write(self, file):
-        write_short(file, self.material_id)
-        write_short_list(file, self.vertex_ids)
+        file.write(SKM_FACE_SCHEMA.pack_fields(self.material_id, self.vertex_ids))
         return
+
+    def pack_into(self, buf, offset):
+        SKM_FACE_SCHEMA.pack_into(buf, offset, self.material_id, *self.vertex_ids)
     
     @staticmethod
     def get_size():
-        return 8
+        return SKM_FACE_SCHEMA.size
 
 ########## SKA structs
+SKA_BONE_SCHEMA = RecordSchema([
+    ("flags", "h"),
+    ("parent_id", "h"),
+    ("name", "40s"),
+    ("field2c", "i"),  # unknown/unused
+    ("field30", "i"),
+    ("scale", "f", 4),
+    ("rotation", "f", 4),
+    ("translation", "f", 4),
+])
+
 class SkaBone(object):
     __slots__ = "flags", "parent_id", "name", "scale", "rotation", "translation"
     flags: int
@@ -227,33 +448,25 @@ class SkaBone(object):
         return None
 
     def from_raw_data(self, rawdata):
-        self.flags = struct.unpack('<h', rawdata[0:2])[0]
-        self.parent_id = struct.unpack('<h', rawdata[2:4])[0]
-        self.name.from_raw_data(rawdata[4:44])
+        (self.flags, self.parent_id, name, field2c, field30,
+         scale, rotation, translation) = SKA_BONE_SCHEMA.unpack_fields(rawdata)
+        self.name.from_raw_data(name)
         # print(self.name.name)
-        field2c = struct.unpack('<i', rawdata[44:48])[0]
-        field30 = struct.unpack('<i', rawdata[48:52])[0]
         if field30 != 0 or field2c != 0:
             print('interesting! field2c = ', field2c)
-        scale = struct.unpack('<4f', rawdata[52:52 + 16])
         self.scale = scale[0:3]
-        rotation = struct.unpack('<4f', rawdata[52 + 16:52 + 32])
         self.rotation = rotation
-        translation = struct.unpack('<4f', rawdata[52 + 32:52 + 48])
         self.translation = translation[0:3]
 
     def write(self, file):
-        write_short(file, self.flags) 
-        write_short(file, self.parent_id)
-        self.name.write(file)
-        file.write( struct.pack("<2i", 0,0)) # unknown/unused fields 0x2c, 0x30
-        write_float_list(file, self.scale + (0.0,) )
-        write_float_list(file, self.rotation)
-        write_float_list(file, self.translation + (0.0,) )
+        file.write(SKA_BONE_SCHEMA.pack_fields(
+            self.flags, self.parent_id, self.name.encode(),
+            0, 0,  # unknown/unused fields 0x2c, 0x30
+            tuple(self.scale) + (0.0,), self.rotation, tuple(self.translation) + (0.0,)))
 
     @staticmethod
     def get_size():
-        return 100
+        return SKA_BONE_SCHEMA.size
 
     def __str__(self):
         return self.name.__str__()
@@ -328,6 +541,14 @@ class SkaAnimKeyframeBoneData(object):
     def get_size():
         return 22
 
+SKA_ANIM_STREAM_HEADER_SCHEMA = RecordSchema([
+    ("frame_count", "H"),
+    ("variation_id", "h"),
+    ("frame_rate", "f"),
+    ("dps", "f"),
+    ("data_offset", "i"),  # relative to the SkaAnimHeader
+])
+
 class SkaAnimStreamHeader(object):
     __slots__ = "frame_count", "variation_id", "frame_rate", "dps", "data_offset"
 
@@ -338,23 +559,21 @@ class SkaAnimStreamHeader(object):
         self.dps = 30.0
         self.data_offset = 0
 
-    def from_raw_data(self, rawdata):
-        self.frame_count = struct.unpack('<H', rawdata[0:2])[0]
-        self.variation_id = struct.unpack('<h', rawdata[2:4])[0]
-        self.frame_rate = struct.unpack('<f', rawdata[4:8])[0]
-        self.dps = struct.unpack('<f', rawdata[8:12])[0]
-        self.data_offset = struct.unpack('<i', rawdata[12:16])[0]
+    def from_raw_data(self, rawdata, offset=0):
+        (self.frame_count, self.variation_id, self.frame_rate, self.dps,
+         self.data_offset) = SKA_ANIM_STREAM_HEADER_SCHEMA.unpack_from(rawdata, offset)
     def write(self, file):
-        write_short(file, self.frame_count)
-        write_short(file, self.variation_id)
-        write_float(file, self.frame_rate)
-        write_float(file, self.dps)
-        assert self.data_offset != 0, "uninited data_offset"
-        write_int(file, self.data_offset)
+        buf = bytearray(self.get_size())
+        self.pack_into(buf, 0)
+        file.write(buf)
         return
+    def pack_into(self, buf, offset):
+        assert self.data_offset != 0, "uninited data_offset"
+        SKA_ANIM_STREAM_HEADER_SCHEMA.pack_into(buf, offset, self.frame_count, self.variation_id,
+                                                self.frame_rate, self.dps, self.data_offset)
     @staticmethod
     def get_size():
-        return 2 + 2 + 4 + 4 + 4
+        return SKA_ANIM_STREAM_HEADER_SCHEMA.size
 
 class SkaAnimStreamInstance:
     """
@@ -369,22 +588,293 @@ class SkaAnimStreamInstance:
         self.frame_rate = frame_rate
         self.dps = dps
 
+class SkaChannelArrays(object):
+    '''
+    Keys of one channel (scale, rotation or location) for all bones of a stream,
+    stored contiguously in CSR layout: the keys of bone bone_ids[i] are
+    frames[offsets[i]:offsets[i + 1]] and values[offsets[i]:offsets[i + 1]].
+
+    bone_ids - (B,) int16
+    offsets - (B+1,) int32
+    frames - (K,) int16
+    values - (K, width) float32; rotations are stored w, x, y, z like the channel dicts
+    '''
+    __slots__ = "width", "bone_ids", "offsets", "frames", "values", "_rows"
+
+    def __init__(self, width, bone_ids=None, offsets=None, frames=None, values=None):
+        self.width = width
+        self.bone_ids = np.zeros(0, np.int16) if bone_ids is None else bone_ids
+        self.offsets = np.zeros(1, np.int32) if offsets is None else offsets
+        self.frames = np.zeros(0, np.int16) if frames is None else frames
+        self.values = np.zeros((0, width), np.float32) if values is None else values
+        self._rows = {bone_idx: row for row, bone_idx in enumerate(self.bone_ids.tolist())}
+
+    @staticmethod
+    def from_quantized(width, keys, factor, column_order=None):
+        '''
+        keys - dict of bone_idx: ([frames], [quantized values, flattened])
+        factor - dequantization factor
+        column_order - reorders the value columns (e.g. rotations from x, y, z, w to w, x, y, z)
+        '''
+        bone_ids = np.fromiter(keys.keys(), np.int16, len(keys))
+        counts = [len(frames) for frames, _ in keys.values()]
+        offsets = np.zeros(len(counts) + 1, np.int32)
+        np.cumsum(counts, out=offsets[1:])
+        key_count = int(offsets[-1])
+        frames = np.fromiter((f for frames, _ in keys.values() for f in frames), np.int16, key_count)
+        values = np.fromiter((v for _, values in keys.values() for v in values), np.float64, key_count * width)
+        values = values.reshape(key_count, width)
+        if column_order is not None:
+            values = values[:, column_order]
+        values = (values * factor).astype(np.float32)
+        return SkaChannelArrays(width, bone_ids, offsets, frames, values)
+
+    @staticmethod
+    def from_dict(channels, width):
+        '''
+        channels - dict of bone_idx: [(frame, [values]), ...]
+        '''
+        bone_ids = np.fromiter(channels.keys(), np.int16, len(channels))
+        counts = [len(keyframes) for keyframes in channels.values()]
+        offsets = np.zeros(len(counts) + 1, np.int32)
+        np.cumsum(counts, out=offsets[1:])
+        key_count = int(offsets[-1])
+        frames = np.fromiter((f for keyframes in channels.values() for f, _ in keyframes), np.int16, key_count)
+        values = np.array([v for keyframes in channels.values() for _, v in keyframes], np.float32)
+        values = values.reshape(key_count, width)
+        return SkaChannelArrays(width, bone_ids, offsets, frames, values)
+
+    def to_dict(self):
+        '''
+        Returns the keys as dict of bone_idx: [(frame, [values]), ...]
+        '''
+        channels = dict()
+        offsets = self.offsets.tolist()
+        frames = self.frames.tolist()
+        values = self.values.tolist()
+        for row, bone_idx in enumerate(self.bone_ids.tolist()):
+            start, end = offsets[row], offsets[row + 1]
+            channels[bone_idx] = list(zip(frames[start:end], values[start:end]))
+        return channels
+
+    def to_mapping(self):
+        '''
+        Returns the keys as a read-only mapping of bone_idx: ((frame, (values)), ...)
+        '''
+        return MappingProxyType({bone_idx: tuple((frame, tuple(values)) for frame, values in keys)
+                                 for bone_idx, keys in self.to_dict().items()})
+
+    def get_keys(self, bone_idx):
+        '''
+        Returns (frames, values) array views of a bone's keys; empty if the bone has none
+        '''
+        row = self._rows.get(bone_idx)
+        if row is None:
+            return self.frames[0:0], self.values[0:0]
+        start, end = self.offsets[row], self.offsets[row + 1]
+        return self.frames[start:end], self.values[start:end]
+
+    @property
+    def key_count(self):
+        return len(self.frames)
+
+    @property
+    def nbytes(self):
+        return self.bone_ids.nbytes + self.offsets.nbytes + self.frames.nbytes + self.values.nbytes
+
+    def set_writeable(self, writeable):
+        '''
+        Makes the arrays (not) editable in place; see SkaAnimStream.mark_dirty
+        '''
+        for attr in ("bone_ids", "offsets", "frames", "values"):
+            array = getattr(self, attr)
+            if array.flags.writeable == writeable:
+                continue
+            try:
+                array.setflags(write=writeable)
+            except ValueError:  # a view of a read-only buffer
+                setattr(self, attr, array.copy())
+
+# Precompiled structs for decoding keyframe streams
+_FLOAT2 = struct.Struct("<ff")
+_FLOAT3 = struct.Struct("<3f")
+_FLOAT4 = struct.Struct("<4f")
+_SHORT = struct.Struct("<h")
+_SHORT3 = struct.Struct("<3h")
+_SHORT4 = struct.Struct("<4h")
+
+# SkaAnimStream decode modes - which representation(s) of the keys read() builds
+DECODE_RAW_FRAMES = 1  # initial_state and raw_frames, as stored in the file
+DECODE_CHANNELS = 2    # scale/rotation/location channel arrays
+DECODE_ALL = DECODE_RAW_FRAMES | DECODE_CHANNELS
+
+def get_raw_key_size():
+    '''
+    Approximate memory taken by one key of the raw frames representation
+    '''
+    bone_data = SkaAnimFileKeyframeBoneData(1, (1000, 1000, 1000), 1000, None, -1, None, -1)
+    return sys.getsizeof(bone_data) + sys.getsizeof(bone_data.scale) + 4 * sys.getsizeof(1000)
+
+# bytes following a bone entry header, by channels_used
+_CHANNEL_DATA_SIZE = tuple((8 if ch & 4 else 0) + (10 if ch & 2 else 0) + (8 if ch & 1 else 0) for ch in range(8))
+
+def _scan_stream_end(buf, offset):
+    '''
+    Returns the offset just past the end of the stream starting at offset,
+    stepping over the keyframes without decoding them
+    '''
+    unpack_short = _SHORT.unpack_from
+    pos = offset + 8
+    # frame 0: bone_idx + 10 shorts per bone, terminated by a negative bone_idx
+    while unpack_short(buf, pos)[0] >= 0:
+        pos += 22
+    pos += 2
+
+    hdr = unpack_short(buf, pos)[0]
+    pos += 2
+    while hdr & 1 == 0:
+        if hdr >> 1 == -1:
+            break
+        hdr = unpack_short(buf, pos)[0]
+        pos += 2
+        while hdr & 1 == 1:
+            pos += _CHANNEL_DATA_SIZE[(hdr >> 1) & 7]
+            hdr = unpack_short(buf, pos)[0]
+            pos += 2
+    return pos
+
+def iter_stream_keys(buf, offset):
+    '''
+    Yields (frame, bone_idx, channel, values) for each key of the stream starting
+    at offset, decoded one at a time straight from buf; stop whenever you like.
+    channel is "scale", "rotation" or "location"; values are dequantized and
+    rounded to float32, exactly as in the channel arrays, with rotations as
+    w, x, y, z.
+
+    Keys come in file order: frame 0 of every bone first, then as the raw frames
+    bring them in. Each bone's keys of a channel increase in frame, but keys of
+    different bones and channels are interleaved.
+    '''
+    unpack_short = _SHORT.unpack_from
+    unpack_scale = _SHORT3.unpack_from
+    unpack_rotation = _SHORT4.unpack_from
+    unpack_location = _SHORT3.unpack_from
+    # round-trip through float32, like SkaChannelArrays.from_quantized
+    to_float3 = _FLOAT3.pack
+    from_float3 = _FLOAT3.unpack
+    to_float4 = _FLOAT4.pack
+    from_float4 = _FLOAT4.unpack
+    scale_factor, location_factor = _FLOAT2.unpack_from(buf, offset)
+    rotation_factor = 1 / 32767.0
+    pos = offset + 8
+
+    bone_idx = unpack_short(buf, pos)[0]
+    pos += 2
+    while bone_idx >= 0:
+        sc = unpack_scale(buf, pos)
+        x, y, z, w = unpack_rotation(buf, pos + 6)
+        loc = unpack_location(buf, pos + 14)
+        pos += 20
+        yield 0, bone_idx, "scale", from_float3(to_float3(
+            sc[0] * scale_factor, sc[1] * scale_factor, sc[2] * scale_factor))
+        yield 0, bone_idx, "rotation", from_float4(to_float4(
+            w * rotation_factor, x * rotation_factor, y * rotation_factor, z * rotation_factor))
+        yield 0, bone_idx, "location", from_float3(to_float3(
+            loc[0] * location_factor, loc[1] * location_factor, loc[2] * location_factor))
+        bone_idx = unpack_short(buf, pos)[0]
+        pos += 2
+
+    hdr = unpack_short(buf, pos)[0]
+    pos += 2
+    while hdr & 1 == 0:
+        if hdr >> 1 == -1:
+            break
+        hdr = unpack_short(buf, pos)[0]
+        pos += 2
+        while hdr & 1 == 1:
+            bone_idx = hdr >> 4
+            channels_used = (hdr >> 1) & 7
+            if channels_used & 4:
+                frame = unpack_short(buf, pos)[0]
+                sc = unpack_scale(buf, pos + 2)
+                pos += 8
+                yield frame, bone_idx, "scale", from_float3(to_float3(
+                    sc[0] * scale_factor, sc[1] * scale_factor, sc[2] * scale_factor))
+            if channels_used & 2:
+                frame = unpack_short(buf, pos)[0]
+                x, y, z, w = unpack_rotation(buf, pos + 2)
+                pos += 10
+                yield frame, bone_idx, "rotation", from_float4(to_float4(
+                    w * rotation_factor, x * rotation_factor, y * rotation_factor, z * rotation_factor))
+            if channels_used & 1:
+                frame = unpack_short(buf, pos)[0]
+                loc = unpack_location(buf, pos + 2)
+                pos += 8
+                yield frame, bone_idx, "location", from_float3(to_float3(
+                    loc[0] * location_factor, loc[1] * location_factor, loc[2] * location_factor))
+            hdr = unpack_short(buf, pos)[0]
+            pos += 2
+
+def _quantize_channel(arrays, inverse_factor, column_order, stream_name, channel_name):
+    '''
+    Quantizes a channel's keys to int16 for raw_frames_from_channels().
+    Returns dict of bone_idx: ([frames], [quantized value tuples])
+    '''
+    values = arrays.values if column_order is None else arrays.values[:, column_order]
+    quantized = np.rint(values.astype(np.float64) * inverse_factor)
+    if quantized.size and (quantized.min() < -32768 or quantized.max() > 32767):
+        raise Exception("SkaAnimStream %s: %s keys overflow int16 with the stream's factors" % (stream_name, channel_name))
+
+    frames = arrays.frames.astype(np.int32)
+    if frames.size and (frames.min() < 0 or frames.max() > 16383):
+        raise Exception("SkaAnimStream %s: %s key frames must be in 0..16383" % (stream_name, channel_name))
+    # a bone's first key is its initial state, which has no frame of its own
+    counts = np.diff(arrays.offsets)
+    if (frames[arrays.offsets[:-1][counts > 0]] != 0).any():
+        raise Exception("SkaAnimStream %s: %s keys of each bone must start at frame 0" % (stream_name, channel_name))
+    # frames must increase within each bone's keys
+    decreasing = np.diff(frames) <= 0
+    bone_ends = arrays.offsets[1:-1] - 1
+    decreasing[bone_ends[(bone_ends >= 0) & (bone_ends < len(decreasing))]] = False
+    if decreasing.any():
+        raise Exception("SkaAnimStream %s: %s key frames must increase" % (stream_name, channel_name))
+
+    frames = frames.tolist()
+    rows = list(map(tuple, quantized.astype(np.int16).tolist()))
+    offsets = arrays.offsets.tolist()
+    keys = dict()
+    for row, bone_idx in enumerate(arrays.bone_ids.tolist()):
+        start, end = offsets[row], offsets[row + 1]
+        if start < end:
+            keys[bone_idx] = (frames[start:end], rows[start:end])
+    return keys
+
 class SkaAnimStream:
     def __init__(self, name):
         """
-        :type data: BytesIO
+        :type data: io.BytesIO
         :type header: SkaAnimStreamHeader
         """
+        # called with the stream when it first gets modified; see SkaFile.get_stream
+        self.on_modified = None
         self.name = name
         self.scale_factor = 1.0
         self.location_factor = 1 / 32767.0
         self.instances = []
 
-        self.scale_channels = dict()
-        self.rotation_channels = dict()
-        self.location_channels = dict()
-        self.initial_state = None
-        self.raw_frames = []
+        # a new stream starts out with (empty) channels; its raw frames are built from them
+        self._scale_arrays = SkaChannelArrays(3)
+        self._rotation_arrays = SkaChannelArrays(4)
+        self._location_arrays = SkaChannelArrays(3)
+        self._initial_state = None
+        self._raw_frames = None
+        self.key_count = 0  # number of channel keys decoded by read()
+        self.skipped_size = 0  # approx. bytes not allocated for the representation read() skipped
+
+        # where read() got the stream from; see get_source_bytes()
+        self.source_span = None  # (start, end) offsets in the source buffer
+        self._source = None
+        self._dirty = True
 
     def add_instance(self, instance):
         """
@@ -392,86 +882,394 @@ class SkaAnimStream:
         """
         self.instances.append(instance)
 
-    def read(self, data):
+    # The file representation. initial_state and raw_frames are mutable, so
+    # handing them out marks the stream as modified and makes them what it gets
+    # encoded from; the channel arrays are rebuilt from them when next accessed.
+    # If the stream was read with DECODE_CHANNELS only, or its channels were
+    # replaced, they get built from the channel arrays on first access.
+    @property
+    def initial_state(self):
+        self._use_raw_frames()
+        return self._initial_state
+
+    @initial_state.setter
+    def initial_state(self, value):
+        self._use_raw_frames()
+        self._initial_state = value
+
+    @property
+    def raw_frames(self):
+        self._use_raw_frames()
+        return self._raw_frames
+
+    @raw_frames.setter
+    def raw_frames(self, value):
+        self._use_raw_frames()
+        self._raw_frames = value
+
+    def _use_raw_frames(self):
+        self._set_dirty()
+        if self._raw_frames is None:
+            self.raw_frames_from_channels()
+        self._scale_arrays = None
+        self._rotation_arrays = None
+        self._location_arrays = None
+
+    @property
+    def scale_factor(self):
+        return self._scale_factor
+
+    @scale_factor.setter
+    def scale_factor(self, value):
+        self._set_dirty()
+        self._scale_factor = value
+
+    @property
+    def location_factor(self):
+        return self._location_factor
+
+    @location_factor.setter
+    def location_factor(self, value):
+        self._set_dirty()
+        self._location_factor = value
+
+    @property
+    def dirty(self):
+        '''
+        True if the stream may differ from the bytes it was read from
+        '''
+        return self._dirty
+
+    def _set_dirty(self):
+        self._dirty = True
+        if self.on_modified is not None:
+            on_modified, self.on_modified = self.on_modified, None
+            on_modified(self)
+
+    def mark_dirty(self, channels=False):
+        '''
+        Call after modifying the stream in a way it can't notice itself
+        (e.g. editing a keyframe obtained before the stream was read).
+        channels - call before editing the channel arrays in place: they're
+                   read-only unless they're what the stream gets encoded
+                   from, so edits can't get lost. This drops the raw frames;
+                   they'll be rebuilt from the arrays.
+        '''
+        self._set_dirty()
+        if channels:
+            self._replace_channel(None, None)
+
+    def _replace_channel(self, attr, arrays):
+        '''
+        Once channel arrays are assigned they're authoritative, and the
+        raw frames get rebuilt from them when needed
+        '''
+        if self._scale_arrays is None:
+            # only built on demand so far
+            self.channels_from_raw_frames()
+        if attr is not None:
+            setattr(self, attr, arrays)
+        self._initial_state = None
+        self._raw_frames = None
+        self._set_channels_writeable(True)
+        self._set_dirty()
+
+    def _set_channels_writeable(self, writeable):
+        for arrays in (self._scale_arrays, self._rotation_arrays, self._location_arrays):
+            if arrays is not None:
+                arrays.set_writeable(writeable)
+
+    def get_source_bytes(self):
+        '''
+        Returns the stream's bytes as read, or None if the stream was modified
+        since or its source buffer has been released (SkaFile.close())
+        '''
+        if self._dirty or self._source is None:
+            return None
+        start, end = self.source_span
+        try:
+            return bytes(self._source[start:end])
+        except ValueError:  # released
+            self._source = None
+            return None
+
+    def detach_source(self):
+        '''
+        Swaps the source buffer for a copy of just the stream's bytes (if it's
+        still unmodified), so the buffer can be released; see SkaFile.save
+        '''
+        data = self.get_source_bytes()
+        if data is None:
+            self._source = None
+        else:
+            self._source = data
+            self.source_span = (0, len(data))
+
+    def iter_keyframes(self):
+        '''
+        Yields (frame, bone_idx, channel, values) for each key; see iter_stream_keys.
+        An unmodified stream is decoded lazily from the buffer it was read from,
+        without building any representation; otherwise the keys come from the
+        channel arrays, bone by bone.
+        '''
+        if not self._dirty and self._source is not None:
+            try:
+                len(self._source)
+            except ValueError:  # released
+                self._source = None
+        if not self._dirty and self._source is not None:
+            for key in iter_stream_keys(self._source, self.source_span[0]):
+                yield key
+            return
+
+        for channel, arrays in (("scale", self.scale_arrays), ("rotation", self.rotation_arrays),
+                                ("location", self.location_arrays)):
+            offsets = arrays.offsets.tolist()
+            for row, bone_idx in enumerate(arrays.bone_ids.tolist()):
+                start, end = offsets[row], offsets[row + 1]
+                for frame, values in zip(arrays.frames[start:end].tolist(), arrays.values[start:end].tolist()):
+                    yield frame, bone_idx, channel, tuple(values)
+
+    # Channel arrays; if the stream was read with DECODE_RAW_FRAMES only,
+    # they get built from the raw frames on first access. Assigning them
+    # replaces the raw frames.
+    @property
+    def scale_arrays(self):
+        if self._scale_arrays is None:
+            self.channels_from_raw_frames()
+        return self._scale_arrays
+
+    @scale_arrays.setter
+    def scale_arrays(self, value):
+        self._replace_channel("_scale_arrays", value)
+
+    @property
+    def rotation_arrays(self):
+        if self._rotation_arrays is None:
+            self.channels_from_raw_frames()
+        return self._rotation_arrays
+
+    @rotation_arrays.setter
+    def rotation_arrays(self, value):
+        self._replace_channel("_rotation_arrays", value)
+
+    @property
+    def location_arrays(self):
+        if self._location_arrays is None:
+            self.channels_from_raw_frames()
+        return self._location_arrays
+
+    @location_arrays.setter
+    def location_arrays(self, value):
+        self._replace_channel("_location_arrays", value)
+
+    # Read-only views of the channel arrays: bone_idx: ((frame, (values)), ...)
+    # They're built on each access, so editing them couldn't change the stream;
+    # to replace a channel's keys, assign a dict of bone_idx: [(frame, [values]), ...],
+    # e.g. a modified dict(stream.rotation_channels).
+    @property
+    def scale_channels(self):
+        return self.scale_arrays.to_mapping()
+
+    @scale_channels.setter
+    def scale_channels(self, channels):
+        self.scale_arrays = SkaChannelArrays.from_dict(channels, 3)
+
+    @property
+    def rotation_channels(self):
+        return self.rotation_arrays.to_mapping()
+
+    @rotation_channels.setter
+    def rotation_channels(self, channels):
+        self.rotation_arrays = SkaChannelArrays.from_dict(channels, 4)
+
+    @property
+    def location_channels(self):
+        return self.location_arrays.to_mapping()
+
+    @location_channels.setter
+    def location_channels(self, channels):
+        self.location_arrays = SkaChannelArrays.from_dict(channels, 3)
+
+    def channels_from_raw_frames(self):
+        '''
+        Builds the channel arrays from initial_state and raw_frames
+        '''
+        scale_keys = dict()
+        rotation_keys = dict()
+        location_keys = dict()
+        for bone_idx, kf in self._initial_state.bone_data.items():
+            scale_keys[bone_idx] = ([0], list(kf.scale))
+            rotation_keys[bone_idx] = ([0], list(kf.rotation))
+            location_keys[bone_idx] = ([0], list(kf.translation))
+        for rawframe in self._raw_frames:
+            for bone_idx, kf in rawframe.bone_data.items():
+                channels_used = (kf.header >> 1) & 7
+                if channels_used & 4:
+                    keys = scale_keys[bone_idx]
+                    keys[0].append(kf.scale_frame)
+                    keys[1].extend(kf.scale)
+                if channels_used & 2:
+                    keys = rotation_keys[bone_idx]
+                    keys[0].append(kf.rotation_frame)
+                    keys[1].extend(kf.rotation)
+                if channels_used & 1:
+                    keys = location_keys[bone_idx]
+                    keys[0].append(kf.translation_frame)
+                    keys[1].extend(kf.translation)
+
+        self._scale_arrays = SkaChannelArrays.from_quantized(3, scale_keys, self._scale_factor)
+        # rotations are stored x, y, z, w
+        self._rotation_arrays = SkaChannelArrays.from_quantized(4, rotation_keys, 1 / 32767.0, [3, 0, 1, 2])
+        self._location_arrays = SkaChannelArrays.from_quantized(3, location_keys, self._location_factor)
+        # the raw frames stay what the stream gets encoded from
+        self._set_channels_writeable(False)
+
+    def raw_frames_from_channels(self):
+        '''
+        Builds initial_state and raw_frames from the channel arrays, which
+        become read-only: from now on the stream is encoded from the raw frames.
+        '''
+        self._initial_state, self._raw_frames = self._build_raw_frames()
+        self._set_channels_writeable(False)
+
+    def _build_raw_frames(self):
+        '''
+        Returns (initial_state, raw_frames) built from the channel arrays, quantized
+        with the stream's factors. The first key of each channel is the bone's
+        initial state; every later key is stored in the raw frame of the key
+        before it, as the file format wants. Each bone needs keys in all three
+        channels.
+        '''
+        scale_keys = _quantize_channel(self._scale_arrays, 1 / self._scale_factor, None, self.name, "scale")
+        # rotations are stored x, y, z, w
+        rotation_keys = _quantize_channel(self._rotation_arrays, 32767.0, [1, 2, 3, 0], self.name, "rotation")
+        location_keys = _quantize_channel(self._location_arrays, 1 / self._location_factor, None, self.name, "location")
+        if not (scale_keys.keys() == rotation_keys.keys() == location_keys.keys()):
+            raise Exception("SkaAnimStream %s: each animated bone needs scale, rotation and location keys" % self.name)
+
+        initial_state = SkaAnimKeyframe(-1)
+        for bone_idx, (_, scales) in scale_keys.items():
+            initial_state.bone_data[bone_idx] = SkaAnimFileKeyframeBoneData(
+                -1, scales[0], -1, rotation_keys[bone_idx][1][0], -1, location_keys[bone_idx][1][0], -1)
+
+        # Bucket the later keys by the frame they're stored at (frames are bounded,
+        # so walking the buckets puts them in file order in linear time), bones in
+        # ascending order within each: (bone_idx, channel bit, its own frame, values)
+        last_frame = max([frames[-2] for keys in (scale_keys, rotation_keys, location_keys)
+                          for frames, _ in keys.values() if len(frames) > 1], default=-1)
+        buckets = [None] * (last_frame + 1)
+        for bone_idx in sorted(scale_keys):
+            for keys, channel in ((scale_keys, 4), (rotation_keys, 2), (location_keys, 1)):
+                frames, values = keys[bone_idx]
+                for i in range(len(frames) - 1):
+                    bucket = buckets[frames[i]]
+                    if bucket is None:
+                        bucket = buckets[frames[i]] = []
+                    bucket.append((bone_idx, channel, frames[i + 1], values[i + 1]))
+
+        raw_frames = []
+        for frame, bucket in enumerate(buckets):
+            if bucket is None:
+                continue
+            rawframe = SkaAnimKeyframe(frame)
+            raw_frames.append(rawframe)
+            for bone_idx, channel, next_frame, values in bucket:
+                kf = rawframe.bone_data.get(bone_idx)
+                if kf is None:
+                    kf = SkaAnimFileKeyframeBoneData((bone_idx << 4) | 1, None, -1, None, -1, None, -1)
+                    rawframe.bone_data[bone_idx] = kf
+                kf.header |= channel << 1
+                if channel == 4:
+                    kf.scale_frame = next_frame
+                    kf.scale = values
+                elif channel == 2:
+                    kf.rotation_frame = next_frame
+                    kf.rotation = values
+                else:
+                    kf.translation_frame = next_frame
+                    kf.translation = values
+
+        return initial_state, raw_frames
+
+    def read(self, data, decode_mode=DECODE_ALL):
         """
-        :type data: BytesIO
+        :type data: io.BytesIO, or any readable file-like object
         """
+        if hasattr(data, "getbuffer"):
+            with data.getbuffer() as buf:
+                end = self.read_buffer(buf, data.tell(), decode_mode)
+            data.seek(end)
+        else:
+            # no buffer to decode from in place - read the rest and step back past the stream
+            start = data.tell()
+            end = self.read_buffer(data.read(), 0, decode_mode)
+            data.seek(start + end)
 
-        (scale_factor, location_factor) = struct.unpack("<ff", data.read(8))
-        self.scale_factor = scale_factor
-        self.location_factor = location_factor
+    def read_buffer(self, buf, offset, decode_mode=DECODE_ALL):
+        """
+        Decodes the stream starting at offset straight from buf (bytes, mmap or memoryview),
+        without copying it. Returns the offset just past the end of the stream.
+        The stream keeps a reference to buf, so get_source_bytes() can hand back
+        the original bytes as long as the stream is unmodified.
+
+        decode_mode - DECODE_RAW_FRAMES, DECODE_CHANNELS or DECODE_ALL.
+        With DECODE_CHANNELS, initial_state and raw_frames are only built (from the
+        channels) if they're accessed.
+        """
+        want_raw = decode_mode & DECODE_RAW_FRAMES
+        want_channels = decode_mode & DECODE_CHANNELS
+        unpack_short = _SHORT.unpack_from
+        unpack_scale = _SHORT3.unpack_from
+        unpack_rotation = _SHORT4.unpack_from
+        unpack_location = _SHORT3.unpack_from
+
+        (scale_factor, location_factor) = _FLOAT2.unpack_from(buf, offset)
+        pos = offset + 8
+        self._scale_factor = scale_factor
+        self._location_factor = location_factor
         rotation_factor = 1 / 32767.0
 
-        scale_channels = dict()
-        rotation_channels = dict()
-        location_channels = dict()
+        # bone_idx: ([frames], [quantized values])
+        scale_keys = dict()
+        rotation_keys = dict()
+        location_keys = dict()
         raw_frames = []
+        key_count = 0
 
-        # Unpack into stream of shorts
-        def next_short():
-            return struct.unpack("<h", data.read(2))[0]
-
-        def next_scale():
-            return struct.unpack("<hhh", data.read(3 * 2))
-            
-        def convert_scale(sc):
-            (x,y,z) = sc
-            return [
-                x * scale_factor,
-                y * scale_factor,
-                z * scale_factor
-            ]
-
-        def next_rotation():
-            return struct.unpack("<hhhh", data.read(4 * 2))
-
-        def convert_rotation(rot):
-            (x, y, z, w) = rot
-            return [
-                w * rotation_factor,
-                x * rotation_factor,
-                y * rotation_factor,
-                z * rotation_factor
-            ]
-        
-        def next_location():
-            return struct.unpack("<hhh", data.read(3 * 2))
-            
-        def convert_location(loc):
-            (x, y, z) = loc
-            return [
-                x * location_factor,
-                y * location_factor,
-                z * location_factor
-            ]
-        
         # Read frame 0 for all affected bones
-        bone_idx = next_short()
+        bone_idx = unpack_short(buf, pos)[0]
+        pos += 2
         frame0 = SkaAnimKeyframe(-1)
-        
+
         while bone_idx >= 0:
-            sc = next_scale()
-            rot = next_rotation()
-            loc = next_location()
-            scale_channels[bone_idx] = [(0, convert_scale(sc))]
-            rotation_channels[bone_idx] = [(0, convert_rotation(rot))]
-            location_channels[bone_idx] = [(0, convert_location(loc))]
-            frame0.bone_data[bone_idx] = SkaAnimFileKeyframeBoneData(-1, sc, -1, rot, -1, loc, -1)
-            bone_idx = next_short()
-
-        self.initial_state = frame0
-
-        # begin reading actual keyframes        
-        hdr = next_short()
+            sc = unpack_scale(buf, pos)
+            rot = unpack_rotation(buf, pos + 6)
+            loc = unpack_location(buf, pos + 14)
+            pos += 20
+            if want_channels:
+                scale_keys[bone_idx] = ([0], list(sc))
+                rotation_keys[bone_idx] = ([0], list(rot))
+                location_keys[bone_idx] = ([0], list(loc))
+            if want_raw:
+                frame0.bone_data[bone_idx] = SkaAnimFileKeyframeBoneData(-1, sc, -1, rot, -1, loc, -1)
+            key_count += 3
+            bone_idx = unpack_short(buf, pos)[0]
+            pos += 2
+
+        # begin reading actual keyframes
+        hdr = unpack_short(buf, pos)[0]
+        pos += 2
         while hdr & 1 == 0:
             frame = hdr >> 1
-            
+
             newframe = SkaAnimKeyframe(frame)
 
             if frame == -1:
                 break
 
-            hdr = next_short()
+            hdr = unpack_short(buf, pos)[0]
+            pos += 2
             while hdr & 1 == 1:
                 bone_idx = hdr >> 4
                 channels_used = (hdr >> 1) & 7
@@ -482,73 +1280,190 @@ class SkaAnimStream:
                 loc = None
                 loc_fr = -1
                 if channels_used & 4:
-                    sc_fr = next_short()
-                    sc = next_scale()
-                    scale_channels[bone_idx].append((sc_fr, convert_scale(sc)))
+                    sc_fr = unpack_short(buf, pos)[0]
+                    sc = unpack_scale(buf, pos + 2)
+                    pos += 8
+                    if want_channels:
+                        keys = scale_keys[bone_idx]
+                        keys[0].append(sc_fr)
+                        keys[1].extend(sc)
+                    key_count += 1
 
                 if channels_used & 2:
-                    rot_fr = next_short()
-                    rot = next_rotation()
-                    rotation_channels[bone_idx].append((rot_fr, convert_rotation(rot)))
+                    rot_fr = unpack_short(buf, pos)[0]
+                    rot = unpack_rotation(buf, pos + 2)
+                    pos += 10
+                    if want_channels:
+                        keys = rotation_keys[bone_idx]
+                        keys[0].append(rot_fr)
+                        keys[1].extend(rot)
+                    key_count += 1
 
                 if channels_used & 1:
-                    loc_fr = next_short()
-                    loc = next_location()
-                    location_channels[bone_idx].append((loc_fr, convert_location(loc)))
-                
-                newframe.bone_data[bone_idx] = SkaAnimFileKeyframeBoneData(hdr, sc, sc_fr, rot, rot_fr, loc, loc_fr)
-                hdr = next_short()
-            
-            raw_frames.append(newframe)
-
-        self.raw_frames = raw_frames
-        self.scale_channels = scale_channels
-        self.rotation_channels = rotation_channels
-        self.location_channels = location_channels
-        
+                    loc_fr = unpack_short(buf, pos)[0]
+                    loc = unpack_location(buf, pos + 2)
+                    pos += 8
+                    if want_channels:
+                        keys = location_keys[bone_idx]
+                        keys[0].append(loc_fr)
+                        keys[1].extend(loc)
+                    key_count += 1
+
+                if want_raw:
+                    newframe.bone_data[bone_idx] = SkaAnimFileKeyframeBoneData(hdr, sc, sc_fr, rot, rot_fr, loc, loc_fr)
+                hdr = unpack_short(buf, pos)[0]
+                pos += 2
+
+            if want_raw:
+                raw_frames.append(newframe)
+
+        if want_raw:
+            self._initial_state = frame0
+            self._raw_frames = raw_frames
+        else:
+            self._initial_state = None
+            self._raw_frames = None
+        if want_channels:
+            self._scale_arrays = SkaChannelArrays.from_quantized(3, scale_keys, scale_factor)
+            # rotations are stored x, y, z, w
+            self._rotation_arrays = SkaChannelArrays.from_quantized(4, rotation_keys, rotation_factor, [3, 0, 1, 2])
+            self._location_arrays = SkaChannelArrays.from_quantized(3, location_keys, location_factor)
+            # unmodified - get_source_bytes() would hand back the bytes whatever the arrays say
+            self._set_channels_writeable(False)
+        else:
+            self._scale_arrays = None
+            self._rotation_arrays = None
+            self._location_arrays = None
+        self.key_count = key_count
+
+        # estimate of what the skipped representation would have taken
+        self.skipped_size = 0
+        if not want_raw:
+            self.skipped_size = key_count * get_raw_key_size()
+        elif not want_channels:
+            self.skipped_size = key_count * 16  # int16 frame + 3 or 4 float32 values
+
+        self.source_span = (offset, pos)
+        self._source = buf
+        self._dirty = False
+        return pos
+
+    def set_decoded(self, decoded, buf, offset):
+        '''
+        Takes on the result of decode_stream_data() for the stream at offset in
+        buf, as if read_buffer() had decoded it with the same decode mode
+        '''
+        scale_factor, location_factor, key_count, size, channels, raw = decoded
+        self._scale_factor = scale_factor
+        self._location_factor = location_factor
+        if raw is not None:
+            self._initial_state, self._raw_frames = raw
+        else:
+            self._initial_state = None
+            self._raw_frames = None
+        if channels is not None:
+            self._scale_arrays, self._rotation_arrays, self._location_arrays = (
+                SkaChannelArrays(width, *arrays) for width, arrays in zip((3, 4, 3), channels))
+            self._set_channels_writeable(False)
+        else:
+            self._scale_arrays = None
+            self._rotation_arrays = None
+            self._location_arrays = None
+        self.key_count = key_count
+
+        self.skipped_size = 0
+        if raw is None:
+            self.skipped_size = key_count * get_raw_key_size()
+        elif channels is None:
+            self.skipped_size = key_count * 16  # int16 frame + 3 or 4 float32 values
+        self.source_span = (offset, offset + size)
+        self._source = buf
+        self._dirty = False
 
     def write(self, file):
-        scale_factor = self.scale_factor
-        location_factor = self.location_factor
-        write_float_list(file, [scale_factor, location_factor])
-
+        file.write(self.to_bytes())
+
+    def to_bytes(self):
+        '''
+        The stream as stored in the file: the bytes it was read from if it's
+        unmodified, otherwise freshly encoded
+        '''
+        data = self.get_source_bytes()
+        if data is None:
+            data = self.encode()
+        return data
+
+    def encode(self):
+        '''
+        Encodes the stream from initial_state and raw_frames, or from the
+        channel arrays if those replaced them (which they keep doing)
+        '''
+        if self._raw_frames is None:
+            initial_state, raw_frames = self._build_raw_frames()
+        else:
+            initial_state, raw_frames = self._initial_state, self._raw_frames
+        shorts = []
 
-        # Write frame 0 for all affected bones
-        for bone_idx, kf in self.initial_state.bone_data.items():
-            write_short(file, bone_idx)
-            write_short_list( file, kf.scale )
-            write_short_list( file, kf.rotation )
-            write_short_list( file, kf.translation )
+        # frame 0 for all affected bones
+        for bone_idx, kf in initial_state.bone_data.items():
+            shorts.append(bone_idx)
+            shorts.extend(kf.scale)
+            shorts.extend(kf.rotation)
+            shorts.extend(kf.translation)
 
         # terminate list of bones
-        write_short(file, -2)
-        
-        # begin writing actual keyframes
-        for rawframe in self.raw_frames:
-            frame = rawframe.frame
-            hdr = ( 0 | (frame << 1) )
-            write_short( file, hdr )
+        shorts.append(-2)
+
+        # actual keyframes
+        for rawframe in raw_frames:
+            shorts.append(rawframe.frame << 1)
 
             for bone_idx, kf in rawframe.bone_data.items():
                 hdr = kf.header
-                write_short(file, hdr)
+                shorts.append(hdr)
 
                 channels_used = (hdr >> 1) & 7
                 if channels_used & 4:
-                    write_short(file, kf.scale_frame)
-                    write_short_list(file, kf.scale)
-                    
+                    shorts.append(kf.scale_frame)
+                    shorts.extend(kf.scale)
                 if channels_used & 2:
-                    write_short(file, kf.rotation_frame)
-                    write_short_list(file, kf.rotation)
-
+                    shorts.append(kf.rotation_frame)
+                    shorts.extend(kf.rotation)
                 if channels_used & 1:
-                    write_short(file, kf.translation_frame)
-                    write_short_list(file, kf.translation)
-            
-        write_short( file, -2) # terminator
-        
-        return
+                    shorts.append(kf.translation_frame)
+                    shorts.extend(kf.translation)
+
+        shorts.append(-2) # terminator
+
+        return _FLOAT2.pack(self._scale_factor, self._location_factor) + struct.pack("<%dh" % len(shorts), *shorts)
+
+def decode_stream_data(data, decode_mode=DECODE_CHANNELS):
+    '''
+    Decodes the stream at the start of data (bytes; anything after the stream
+    is ignored). Runs in SkaFile.read's worker processes, so the channels come
+    back as plain arrays, which pickle compactly (the raw frames don't - use
+    DECODE_CHANNELS there if you can):
+    (scale_factor, location_factor, key_count, stream size, channels, raw), where
+    channels are (bone_ids, offsets, frames, values) for scale, rotation and location,
+    and raw is (initial_state, raw_frames); either is None if decode_mode skips it
+    '''
+    stream = SkaAnimStream("")
+    size = stream.read_buffer(data, 0, decode_mode)
+    channels = None
+    if decode_mode & DECODE_CHANNELS:
+        channels = tuple((arrays.bone_ids, arrays.offsets, arrays.frames, arrays.values)
+                         for arrays in (stream._scale_arrays, stream._rotation_arrays, stream._location_arrays))
+    raw = None
+    if decode_mode & DECODE_RAW_FRAMES:
+        raw = (stream._initial_state, stream._raw_frames)
+    return stream.scale_factor, stream.location_factor, stream.key_count, size, channels, raw
+
+SKA_EVENT_SCHEMA = RecordSchema([
+    ("frame_id", "h"),
+    ("type", "48s"),
+    ("action", "128s"),
+])
+
 class SkaEvent(object):
     __slots__ = "frame_id", "type", "action"
 
@@ -560,27 +1475,36 @@ class SkaEvent(object):
     @staticmethod
     def from_raw_data(rawdata, count):
         result = []
-        max_count = len(rawdata) / SkaEvent.get_size()
+        DATUM_SIZE = SkaEvent.get_size()
+        max_count = len(rawdata) // DATUM_SIZE
         if count < max_count:
             count = max_count
-        DATUM_SIZE = SkaEvent.get_size()
         for i in range(0, count):
             new_event = SkaEvent()
-            new_event.frame_id = struct.unpack('<h', rawdata[0 + i * DATUM_SIZE:2 + i * DATUM_SIZE])[0]
-            new_event.type.from_raw_data(rawdata[2 + i * DATUM_SIZE:2 + 48 + i * DATUM_SIZE])
-            new_event.action.from_raw_data(rawdata[50 + i * DATUM_SIZE:50 + 128 + i * DATUM_SIZE])
+            new_event.frame_id, event_type, action = SKA_EVENT_SCHEMA.unpack_fields(rawdata, i * DATUM_SIZE)
+            new_event.type.from_raw_data(event_type)
+            new_event.action.from_raw_data(action)
             result.append(new_event)
         return result
 
     def write(self, file):
-        write_short(file, self.frame_id)
-        self.type.write(file)
-        self.action.write(file)
+        file.write(SKA_EVENT_SCHEMA.pack_fields(self.frame_id, self.type.encode(), self.action.encode()))
         return
 
     @staticmethod
     def get_size():
-        return 2 + 48 + 128
+        return SKA_EVENT_SCHEMA.size
+
+SKA_ANIM_HEADER_SCHEMA = RecordSchema([
+    ("name", "64s"),
+    ("drive_type", "b"),
+    ("loopable", "b"),
+    ("event_count", "h"),
+    ("event_offset", "i"),  # relative to the SkaAnimHeader
+    ("stream_count", "h"),
+    ("unk", "h"),
+    ("stream_headers", SKA_ANIM_STREAM_HEADER_SCHEMA, 10),
+])
 
 class SkaAnimHeader(object):
     __slots__ = "name", "drive_type", "loopable", "event_count", "event_offset", "stream_count", "unk", "stream_headers"
@@ -595,51 +1519,72 @@ class SkaAnimHeader(object):
         self.stream_headers = []
 
     def from_raw_data(self, rawdata):
-        self.name.from_raw_data(rawdata[0:64])
-        self.drive_type = struct.unpack('<b', rawdata[64:65])[0]
-        self.loopable = struct.unpack('<b', rawdata[65:66])[0]
-        self.event_count = struct.unpack('<h', rawdata[66:68])[0]
-        self.event_offset = struct.unpack('<i', rawdata[68:72])[0]
-        self.stream_count = struct.unpack('<h', rawdata[72:74])[0]
-        unk = struct.unpack('<h', rawdata[74:76])[0]
+        schema = SKA_ANIM_HEADER_SCHEMA
+        self.name.from_raw_data(schema.get(rawdata, "name"))
+        self.drive_type = schema.get(rawdata, "drive_type")
+        self.loopable = schema.get(rawdata, "loopable")
+        self.event_count = schema.get(rawdata, "event_count")
+        self.event_offset = schema.get(rawdata, "event_offset")
+        self.stream_count = schema.get(rawdata, "stream_count")
         self.stream_headers = []
-        for i in range(0, 10):
+        DATUM_SIZE = SkaAnimStreamHeader.get_size()
+        for i in range(0, min(self.stream_count, 10)):
             new_stream_header = SkaAnimStreamHeader()
-            DATUM_SIZE = SkaAnimStreamHeader.get_size()
-            offset = 76 + i * DATUM_SIZE
-            new_stream_header.from_raw_data(rawdata[offset:offset + DATUM_SIZE])
-            if i < self.stream_count:
-                self.stream_headers.append(new_stream_header)
+            new_stream_header.from_raw_data(rawdata, schema.offsets["stream_headers"] + i * DATUM_SIZE)
+            self.stream_headers.append(new_stream_header)
     def write(self, file):
-        self.name.write(file) # 64
-        write_byte(file, self.drive_type) #65
-        write_byte(file, self.loopable) #66
-        write_short(file, self.event_count) #68
+        buf = bytearray(self.get_size())
+        self.pack_into(buf, 0)
+        file.write(buf)
+        return
+    def pack_into(self, buf, offset):
+        '''
+        buf must be zeroed - unused stream headers are left as they are
+        '''
+        schema = SKA_ANIM_HEADER_SCHEMA
         assert self.event_offset != 0, "Uninited event_offset"
-        write_int(file, self.event_offset) # TODO
-        write_short(file, self.stream_count)
-        write_short(file, 0) # unk
+        schema.set(buf, "name", self.name.encode(), offset)
+        schema.set(buf, "drive_type", self.drive_type, offset)
+        schema.set(buf, "loopable", self.loopable, offset)
+        schema.set(buf, "event_count", self.event_count, offset)
+        schema.set(buf, "event_offset", self.event_offset, offset)
+        schema.set(buf, "stream_count", self.stream_count, offset)
         # AnimStreamHeader array
         DATUM_SIZE = SkaAnimStreamHeader.get_size()
-        for i in range (0, self.stream_count):    
-            # offset = 76 + i * DATUM_SIZE
-            stream_header = self.stream_headers[i]
-            stream_header.write(file)
-        for i in range(self.stream_count, 10):
-            file.write( struct.pack("%db" % DATUM_SIZE, *DATUM_SIZE*[0,] ) )
-        
-        return
+        for i in range(0, self.stream_count):
+            self.stream_headers[i].pack_into(buf, offset + schema.offsets["stream_headers"] + i * DATUM_SIZE)
     @staticmethod
     def get_size():
-        return 64 + 1 + 1 + 2 + 4 + 2 + 2 + 10 * SkaAnimStreamHeader.get_size()
+        return SKA_ANIM_HEADER_SCHEMA.size
 
 class SkaAnim(object):
-    __slots__ = "header", "events", "streams"
+    __slots__ = "header", "events", "_streams", "_stream_starts", "_owner"
     header: SkaAnimHeader
     def __init__(self):
         self.header = SkaAnimHeader()
         self.events = []
-        self.streams = []
+        self._streams = []
+        self._stream_starts = []
+        self._owner = None
+
+    @property
+    def streams(self):
+        '''
+        For animations of a lazily read SkaFile, the streams are decoded on access
+        '''
+        if self._streams is None:
+            return [self._owner.get_stream(stream_start) for stream_start in self._stream_starts]
+        return self._streams
+
+    @streams.setter
+    def streams(self, value):
+        self._streams = value
+
+    def get_stream_starts(self):
+        '''
+        Offsets of the animation's streams in the file buffer (set by SkaFile.read)
+        '''
+        return list(self._stream_starts)
 
     def from_raw_data(self, rawdata):
         self.header.from_raw_data(rawdata)
@@ -647,9 +1592,127 @@ class SkaAnim(object):
     def get_size(self):
         return self.header.get_size() + 2 + 4
 
+def make_bone_name_index(names):
+    '''
+    Returns dict of casefolded bone name: index of the first bone with that name
+    '''
+    index = dict()
+    for idx, name in enumerate(names):
+        index.setdefault(str(name).casefold(), idx)
+    return index
+
+def match_anim_names(names, pattern):
+    '''
+    Returns the indices of the names matching pattern: comma-separated glob
+    patterns (e.g. "unarmed_unarmed_*, *_idle"), case-insensitive.
+    An empty or None pattern matches everything.
+    '''
+    globs = [glob.strip().casefold() for glob in (pattern or "").split(",") if glob.strip()]
+    if not globs:
+        return list(range(len(names)))
+    return [i for i, name in enumerate(names)
+            if any(fnmatch.fnmatchcase(name.casefold(), glob) for glob in globs)]
+
+class SkaAnimInfo(object):
+    '''
+    Catalog entry of an animation, read from its header alone
+    (see read_anim_catalog). frame_count, frame_rate and dps are those of the
+    first stream; stream_sizes are the byte sizes of all its streams.
+    '''
+    __slots__ = "index", "name", "drive_type", "loopable", "frame_count", "frame_rate", "dps", \
+                "event_count", "stream_count", "stream_starts", "stream_sizes"
+
+    def __init__(self, index, header, header_start, stream_ends):
+        self.index = index
+        self.name = str(header.name)
+        self.drive_type = header.drive_type
+        self.loopable = header.loopable
+        self.event_count = header.event_count
+        self.stream_count = header.stream_count
+        self.stream_starts = [header_start + sh.data_offset for sh in header.stream_headers]
+        self.stream_sizes = [stream_ends[start] - start for start in self.stream_starts]
+        first_stream = header.stream_headers[0] if header.stream_headers else SkaAnimStreamHeader()
+        self.frame_count = first_stream.frame_count
+        self.frame_rate = first_stream.frame_rate
+        self.dps = first_stream.dps
+
+    def __repr__(self):
+        return "%s: %d frames @ %g fps, dps %g, loopable %d, %d events, streams %s bytes" % (
+            self.name, self.frame_count, self.frame_rate, self.dps, self.loopable, self.event_count,
+            self.stream_sizes)
+
+def read_anim_catalog(file, use_mmap=True):
+    '''
+    Lists the animations of an SKA file from their headers alone; no stream
+    is decoded, and with use_mmap only the header pages get loaded.
+    A stream's size runs up to the next stream or event block.
+    Returns a list of SkaAnimInfo.
+    '''
+    mapping, buf = open_file_buffer(file, use_mmap)
+    try:
+        anim_count = SKA_FILE_HEADER_SCHEMA.get(buf, "anim_count")
+        anim_offset = SKA_FILE_HEADER_SCHEMA.get(buf, "anim_offset")
+        HEADER_SIZE = SkaAnimHeader.get_size()
+        if anim_count < 0 or anim_offset + anim_count * HEADER_SIZE > len(buf):
+            raise Exception("SkaFile: invalid animation table")
+
+        headers = []
+        boundaries = {len(buf)}
+        for i in range(anim_count):
+            header_start = anim_offset + i * HEADER_SIZE
+            header = SkaAnimHeader()
+            header.from_raw_data(buf[header_start:header_start + HEADER_SIZE])
+            headers.append((header, header_start))
+            if header.event_count > 0:
+                boundaries.add(header_start + header.event_offset)
+            for sh in header.stream_headers:
+                stream_start = header_start + sh.data_offset
+                if not 0 <= stream_start < len(buf):
+                    raise Exception("SkaFile: invalid animation table")
+                boundaries.add(stream_start)
+
+        boundaries = sorted(boundaries)
+        stream_ends = {start: end for start, end in zip(boundaries, boundaries[1:])}
+        return [SkaAnimInfo(i, header, header_start, stream_ends) for i, (header, header_start) in enumerate(headers)]
+    finally:
+        close_file_buffer(mapping, buf)
+
+class SkaLayout(object):
+    '''
+    Where SkaFile.write() puts everything; absolute file offsets
+    '''
+    __slots__ = "bone_data_offset", "variation_data_offset", "animation_data_offset", \
+                "event_data_offset", "stream_data_offset", "stream_data", "file_size", \
+                "duplicate_streams", "duplicate_bytes", "copied_streams", "encoded_streams"
+
+    def __init__(self):
+        self.bone_data_offset = 24
+        self.variation_data_offset = 0
+        self.animation_data_offset = 0
+        self.event_data_offset = 0
+        self.stream_data_offset = 0
+        self.stream_data = []  # encoded streams, in file order
+        self.file_size = 0
+        self.duplicate_streams = 0  # streams stored only once because their bytes matched an earlier one
+        self.duplicate_bytes = 0
+        self.copied_streams = 0  # unmodified streams copied from the file they were read from
+        self.encoded_streams = 0
+
 ########
 class SkaFile:
-    streams = ...  # type: List[SkaAnimStream]
+    '''
+    With read(lazy=True) only the bone table and the animation headers are parsed
+    up front; each stream is decoded (and memoized) the first time it's accessed
+    through SkaFile.streams or SkaAnim.streams. max_resident_streams caps how many
+    decoded streams stay memoized (least recently used ones get dropped, and are
+    decoded again on their next access); modified streams are never dropped.
+
+    write() copies unmodified streams verbatim from the buffer they were read
+    from, as long as it's still open (lazy reads, or non-mmap reads until
+    close()); only modified streams get re-encoded. That buffer may be a memory
+    mapping of the source file, so use save() to write back to the file read
+    from: opening it for writing would truncate the mapped file under write().
+    '''
     bone_data: List[SkaBone]
     animation_data: List[SkaAnim]
     def __init__(self):
@@ -657,21 +1720,115 @@ class SkaFile:
         self.variation_data = []
         self.animation_data = []
         self.streams = []
+        self.max_resident_streams = None
+        self.decode_mode = DECODE_ALL
         self._fileraw = b""
+        self._mmap = None
+
+        # stream index - filled by read_animation_data
+        self._stream_starts = []
+        self._stream_names = dict()
+        self._stream_instances = dict()
+        self._stream_cache = OrderedDict()
+        # every stream handed out and still referenced somewhere, by offset
+        self._live_streams = weakref.WeakValueDictionary()
+        # streams modified since they were decoded, kept whatever the cache does
+        self._modified_streams = dict()
+
+        # (bone names, index) - see get_bone_name_index
+        self._bone_name_index = ((), dict())
+        # (bone count, Skeleton) - see skeleton.get_skeleton
+        self._skeleton = (-1, None)
 
-    def read(self, file):
-
-        time1 = time.clock()
-
-        self._fileraw = file.read()
+    @property
+    def streams(self):
+        if self._streams is None:
+            return [self.get_stream(stream_start) for stream_start in self._stream_starts]
+        return self._streams
+
+    @streams.setter
+    def streams(self, value):
+        self._streams = value
+
+    def read(self, file, use_mmap=False, lazy=False, max_resident_streams=None, decode_mode=DECODE_ALL,
+             workers=None):
+        '''
+        use_mmap - memory-map the file instead of reading it into memory
+        lazy - don't decode animation streams until they're accessed.
+               The file buffer is then kept until close() is called.
+        max_resident_streams - max. number of decoded streams kept memoized (None for no limit)
+        decode_mode - which stream representation(s) to build; see SkaAnimStream.read_buffer
+        workers - decode the streams in this many processes (see read_streams_parallel);
+                  None or 1 to decode them here. Needs lazy=False. Not for use inside Blender.
+        '''
+
+        if lazy and workers is not None and workers > 1:
+            raise Exception("SkaFile: workers needs lazy=False; lazily read streams are decoded on access")
+
+        time1 = time.perf_counter()
+
+        self._mmap, self._fileraw = open_file_buffer(file, use_mmap)
+        self.max_resident_streams = max_resident_streams
+        self.decode_mode = decode_mode
         self.get_bone_data()
         self.get_variation_data()
-        self.read_animation_data()
-        print(" done in %.2f sec." % (time.clock() - time1))
+        self.read_animation_data(lazy, workers)
+        if use_mmap and not lazy:
+            self.close()
+        print(" done in %.2f sec." % (time.perf_counter() - time1))
+
+    def get_file_buffer(self):
+        '''
+        The buffer read() decoded from; for lazily read files it's kept until close()
+        '''
+        return self._fileraw
+
+    def get_stream_starts(self):
+        '''
+        Offsets of the distinct streams in the file buffer, in the order read() found them
+        '''
+        return list(self._stream_starts)
+
+    def get_anim_names(self):
+        return [str(anim.header.name) for anim in self.animation_data]
+
+    def find_animations(self, pattern):
+        '''
+        Indices of the animations whose names match pattern; see match_anim_names
+        '''
+        return match_anim_names(self.get_anim_names(), pattern)
+
+    def iter_keyframes(self, stream_starts=None):
+        '''
+        Yields (stream_start, frame, bone_idx, channel, values) for each key of
+        the given streams (default: all, in file order), decoded one at a time
+        from the file buffer; read the file with lazy=True so nothing else gets
+        decoded. See iter_stream_keys.
+        '''
+        try:
+            buffer_size = len(self._fileraw)
+        except ValueError:  # released
+            buffer_size = 0
+        if buffer_size == 0:
+            raise Exception("SkaFile: the file buffer has been released; iter_keyframes needs a "
+                            "read(lazy=True) that hasn't been close()d")
+        if stream_starts is None:
+            stream_starts = self._stream_starts
+        for stream_start in stream_starts:
+            for key in iter_stream_keys(self._fileraw, stream_start):
+                yield (stream_start,) + key
+
+    def close(self):
+        '''
+        Releases the file buffer (and memory mapping) held since read()
+        '''
+        close_file_buffer(self._mmap, self._fileraw)
+        self._mmap = None
+        self._fileraw = b""
 
     def get_bone_data(self):
-        count = struct.unpack('<i', self._fileraw[0:4])[0]
-        offset = struct.unpack('<i', self._fileraw[4:8])[0]
+        count = SKA_FILE_HEADER_SCHEMA.get(self._fileraw, "bone_count")
+        offset = SKA_FILE_HEADER_SCHEMA.get(self._fileraw, "bone_offset")
         print(count, 'bones, offset: ', offset)
 
         DATUM_SIZE = SkaBone.get_size()
@@ -680,22 +1837,29 @@ class SkaFile:
             newDatum = SkaBone()
             newDatum.from_raw_data(self._fileraw[data_start:data_start + DATUM_SIZE])
             self.bone_data.append(newDatum)
+        self.get_bone_name_index()
 
     def get_variation_data(self):
-        count = struct.unpack('<i', self._fileraw[8:12])[0]
-        offset = struct.unpack('<i', self._fileraw[12:16])[0]
+        count = SKA_FILE_HEADER_SCHEMA.get(self._fileraw, "variation_count")
+        offset = SKA_FILE_HEADER_SCHEMA.get(self._fileraw, "variation_offset")
         # do nothing, because it seems ToEE doesn't have this in practice
 
-    def read_animation_data(self):
-        count = struct.unpack('<i', self._fileraw[16:20])[0]
-        offset = struct.unpack('<i', self._fileraw[20:24])[0]
+    def read_animation_data(self, lazy=False, workers=None):
+        count = SKA_FILE_HEADER_SCHEMA.get(self._fileraw, "anim_count")
+        offset = SKA_FILE_HEADER_SCHEMA.get(self._fileraw, "anim_offset")
 
         # Streams are reused between animations
-        streams_by_start = dict()
+        self._stream_starts = []
+        self._stream_names = dict()
+        self._stream_instances = dict()
+        self._stream_cache = OrderedDict()
+        self._live_streams = weakref.WeakValueDictionary()
+        self._modified_streams = dict()
 
         # get data headers first
         HEADER_SIZE = SkaAnimHeader.get_size()
         EVENT_SIZE = SkaEvent.get_size()
+        event_starts = []
         data_start = offset
         for i in range(0, count):
 
@@ -710,69 +1874,287 @@ class SkaFile:
             if event_count > 0:
                 newDatum.events = SkaEvent.from_raw_data(
                     self._fileraw[event_offset:event_offset + event_count * EVENT_SIZE], event_count)
+                event_starts.append(event_offset)
 
-            newDatum.streams = []
+            newDatum.streams = None
+            newDatum._owner = self
             for stream_header in newDatum.header.stream_headers:
 
                 stream_start = data_start + stream_header.data_offset
-                if stream_start not in streams_by_start:
-                    stream = SkaAnimStream(newDatum.header.name)
-                    io = BytesIO(self._fileraw)
-                    io.seek(stream_start)
-                    stream.read(io)
-                    streams_by_start[stream_start] = stream
-                else:
-                    stream = streams_by_start[stream_start]
+                if stream_start not in self._stream_instances:
+                    self._stream_starts.append(stream_start)
+                    self._stream_names[stream_start] = newDatum.header.name
+                    self._stream_instances[stream_start] = []
 
-                stream.instances.append(SkaAnimStreamInstance(
+                self._stream_instances[stream_start].append(SkaAnimStreamInstance(
                     str(newDatum.header.name),
                     stream_header.frame_rate,
                     stream_header.dps
                 ))
-                newDatum.streams.append(stream)
+                newDatum._stream_starts.append(stream_start)
 
             self.animation_data.append(newDatum)
 
             data_start += HEADER_SIZE
 
-        self.streams = streams_by_start.values()
+        self.streams = None
+        if not lazy:
+            # decode everything now
+            time1 = time.perf_counter()
+            if workers is not None and workers > 1:
+                self.streams = self.read_streams_parallel(workers, event_starts)
+            else:
+                self.streams = [self.read_stream(stream_start) for stream_start in self._stream_starts]
+            decode_time = time.perf_counter() - time1
+            key_count = sum(stream.key_count for stream in self.streams)
+            print("%d streams, %d keys decoded in %.3f sec (%.0f keys/sec)"
+                  % (len(self.streams), key_count, decode_time, key_count / max(decode_time, 1e-9)))
+            if self.decode_mode != DECODE_ALL:
+                skipped_size = sum(stream.skipped_size for stream in self.streams)
+                print("decode mode %d: ~%.2f MB saved" % (self.decode_mode, skipped_size / 2**20))
+            streams_by_start = dict(zip(self._stream_starts, self.streams))
+            for anim in self.animation_data:
+                anim.streams = [streams_by_start[stream_start] for stream_start in anim._stream_starts]
 
         return
 
+    def get_stream(self, stream_start):
+        '''
+        Returns the stream starting at stream_start, decoding it if it isn't memoized.
+        A stream dropped from the memo but still referenced elsewhere is handed out
+        again rather than decoded anew, so edits made through any reference count.
+        '''
+        stream = self._stream_cache.get(stream_start)
+        if stream is not None:
+            self._stream_cache.move_to_end(stream_start)
+            return stream
+
+        stream = self._find_stream(stream_start)
+        if stream is None:
+            stream = self.read_stream(stream_start)
+            self._live_streams[stream_start] = stream
+            stream.on_modified = self._keep_modified_stream
+        self._stream_cache[stream_start] = stream
+        if self.max_resident_streams is not None:
+            # modified streams are kept in _modified_streams, so their edits aren't lost
+            while len(self._stream_cache) > max(self.max_resident_streams, 1):
+                self._stream_cache.popitem(last=False)
+        return stream
+
+    def _find_stream(self, stream_start):
+        '''
+        The decoded stream at stream_start if one exists (memoized, modified or
+        still referenced somewhere), else None
+        '''
+        stream = self._stream_cache.get(stream_start)
+        if stream is None:
+            stream = self._modified_streams.get(stream_start)
+        if stream is None:
+            stream = self._live_streams.get(stream_start)
+        return stream
+
+    def _keep_modified_stream(self, stream):
+        self._modified_streams[stream.source_span[0]] = stream
+
+    def read_streams_parallel(self, workers, event_starts=()):
+        '''
+        Decodes the streams in a pool of worker processes, each stream's bytes
+        handed over up to the next stream or event block, with the file's decode
+        mode. DECODE_CHANNELS is the fastest by far: the channel arrays come
+        back compactly, while raw frames have to be pickled object by object.
+        '''
+        boundaries = sorted(set(self._stream_starts) | set(event_starts) | {len(self._fileraw)})
+        stream_ends = dict(zip(boundaries, boundaries[1:]))
+        stream_data = [bytes(self._fileraw[stream_start:stream_ends[stream_start]])
+                       for stream_start in self._stream_starts]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(decode_stream_data, stream_data, [self.decode_mode] * len(stream_data),
+                                        chunksize=max(1, len(stream_data) // (workers * 4))))
+
+        streams = []
+        for stream_start, decoded in zip(self._stream_starts, results):
+            stream = SkaAnimStream(self._stream_names[stream_start])
+            stream.set_decoded(decoded, self._fileraw, stream_start)
+            stream.instances.extend(self._stream_instances[stream_start])
+            streams.append(stream)
+        return streams
+
+    def read_stream(self, stream_start):
+        stream = SkaAnimStream(self._stream_names[stream_start])
+        stream.read_buffer(self._fileraw, stream_start, self.decode_mode)
+        stream.instances.extend(self._stream_instances[stream_start])
+        return stream
+
+    def plan_layout(self):
+        '''
+        Encodes the streams and works out where everything goes, fixing up the
+        counts and offsets of every animation header on the way. Streams shared
+        between animations, or encoding to the same bytes, are stored once.
+        Returns the SkaLayout that write() follows.
+        '''
+        assert len(self.variation_data) == 0, "no variation data expected!"
+
+        HEADER_SIZE = SkaAnimHeader.get_size()
+        EVENT_SIZE = SkaEvent.get_size()
+
+        layout = SkaLayout()
+        layout.bone_data_offset = SKA_FILE_HEADER_SCHEMA.size  # always 24
+        layout.variation_data_offset = layout.bone_data_offset + self.get_bone_data_length()
+        layout.animation_data_offset = layout.variation_data_offset + self.get_variation_data_length()
+        layout.event_data_offset = layout.animation_data_offset + len(self.animation_data) * HEADER_SIZE
+
+        # structure:
+        # SkaAnimHeader[]
+        # SkaEvent[]
+        # stream data
+        # event_offset and data_offset are relative to the start of their SkaAnimHeader
+        event_pos = layout.event_data_offset
+        for i, anim_datum in enumerate(self.animation_data):
+            header_start = layout.animation_data_offset + i * HEADER_SIZE
+            anim_datum.header.event_count = len(anim_datum.events)
+            anim_datum.header.event_offset = event_pos - header_start
+            event_pos += len(anim_datum.events) * EVENT_SIZE
+        layout.stream_data_offset = event_pos
+
+        stream_pos = event_pos
+        stream_offsets = dict()  # stream -> absolute offset
+        content_offsets = dict()  # digest of the encoded stream -> absolute offset
+        layout.stream_data = []
+        for i, anim_datum in enumerate(self.animation_data):
+            header_start = layout.animation_data_offset + i * HEADER_SIZE
+            header = anim_datum.header
+            if anim_datum._streams is None:
+                # lazily read - streams that were never decoded (or are no longer
+                # referenced anywhere) are left as their file offset
+                streams = [self._find_stream(stream_start) or stream_start
+                           for stream_start in anim_datum._stream_starts]
+            else:
+                streams = anim_datum.streams
+            if len(streams) != len(header.stream_headers):
+                raise Exception("SkaFile: animation %s has %d streams but %d stream headers"
+                                % (header.name, len(streams), len(header.stream_headers)))
+            if len(streams) > 10:
+                raise Exception("SkaFile: animation %s has more than 10 streams" % header.name)
+            header.stream_count = len(streams)
+
+            for stream, stream_header in zip(streams, header.stream_headers):
+                stream_start = stream_offsets.get(stream)
+                if stream_start is None:
+                    data = self.get_stream_data(stream, layout)
+                    digest = hashlib.sha1(data).digest()
+                    stream_start = content_offsets.get(digest)
+                    if stream_start is None:
+                        stream_start = stream_pos
+                        content_offsets[digest] = stream_start
+                        layout.stream_data.append(data)
+                        stream_pos += len(data)
+                    else:
+                        layout.duplicate_streams += 1
+                        layout.duplicate_bytes += len(data)
+                    stream_offsets[stream] = stream_start
+                stream_header.data_offset = stream_start - header_start
+
+        layout.file_size = stream_pos
+        return layout
+
+    def get_stream_data(self, stream, layout):
+        '''
+        stream - SkaAnimStream, or the file offset of a stream that wasn't decoded
+        '''
+        if isinstance(stream, int):
+            data = bytes(self._fileraw[stream:_scan_stream_end(self._fileraw, stream)])
+        else:
+            data = stream.get_source_bytes()
+        if data is None:
+            data = stream.encode()
+            layout.encoded_streams += 1
+        else:
+            layout.copied_streams += 1
+        return data
+
     def write(self, file):
-        # first write the header
-
-        # bone data - count, offset [0:8]
-        bone_count = len(self.bone_data)
-        bone_data_offset = 24  # always 24
-        file.write(struct.pack("<2i", bone_count, bone_data_offset))
-
-        # #variation data - count, offset [8:16]
-        variation_count = len(self.variation_data)
-        variation_data_offset = bone_data_offset + self.get_bone_data_length()
-        file.write(struct.pack("<2i", variation_count, variation_data_offset))
-        # shouldn't actually have data here, heh
-        assert variation_count == 0, "no variation data expected!"
-
-        # animation data -count, offset [16:24]
-        animation_count = len(self.animation_data)
-        animation_data_offset = variation_data_offset + self.get_variation_data_length()  #
-        file.write(struct.pack("<2i", animation_count, animation_data_offset))
-
-        # *** write data ***
+        '''
+        Writes to an open file. Don't pass the file this one was read from with
+        use_mmap (or, for lazy reads, at all): opening it for writing truncates
+        the source of the streams still to be copied - use save() instead.
+        '''
+        time1 = time.perf_counter()
+        layout = self.plan_layout()
+
+        # header
+        file.write(SKA_FILE_HEADER_SCHEMA.pack_fields(
+            len(self.bone_data), layout.bone_data_offset,
+            len(self.variation_data), layout.variation_data_offset,
+            len(self.animation_data), layout.animation_data_offset))
+
         # bone data
         self.write_bones(file)
 
         # variation data - shouldn't be any...
-        pass
-        
-        # animation data
-        self.write_animation_data(file, animation_data_offset)
 
-        return
+        # animation data
+        for anim_datum in self.animation_data:
+            anim_datum.header.write(file)
+        for anim_datum in self.animation_data:
+            for event in anim_datum.events:
+                event.write(file)
+        for data in layout.stream_data:
+            file.write(data)
+
+        print("SKA written: %d bytes, %d streams (%d copied, %d encoded) in %.3f sec"
+              % (layout.file_size, len(layout.stream_data), layout.copied_streams, layout.encoded_streams,
+                 time.perf_counter() - time1))
+        if layout.duplicate_streams:
+            print("%d duplicate streams stored once, %d bytes saved"
+                  % (layout.duplicate_streams, layout.duplicate_bytes))
+        return layout
+
+    def save(self, filepath):
+        '''
+        Writes to filepath, which may be the file this one was read from: the
+        data goes to a temporary file next to it, which then replaces filepath.
+        Before that the file buffer is released (it can't be replaced while
+        it's open or mapped on Windows), so the streams are all decoded first
+        and keep copies of their own bytes - a lazily read file stops being lazy.
+        Close the file passed to read() first.
+        '''
+        temp_filepath = filepath + ".tmp"
+        try:
+            with open(temp_filepath, 'wb') as file:
+                layout = self.write(file)
+            self.detach_streams()
+            self.close()
+            os.replace(temp_filepath, filepath)
+        except Exception:
+            if os.path.exists(temp_filepath):
+                os.remove(temp_filepath)
+            raise
+        return layout
+
+    def detach_streams(self):
+        '''
+        Decodes the streams that haven't been yet and makes every stream keep a
+        copy of its own bytes instead of referencing the file buffer, so that
+        can be released without losing anything
+        '''
+        if self._streams is None:
+            streams_by_start = {stream_start: self.get_stream(stream_start) for stream_start in self._stream_starts}
+            for anim in self.animation_data:
+                if anim._streams is None:
+                    anim.streams = [streams_by_start[stream_start] for stream_start in anim._stream_starts]
+            self.streams = [streams_by_start[stream_start] for stream_start in self._stream_starts]
+        streams = set(self._streams)
+        for anim in self.animation_data:
+            streams.update(anim.streams)
+        for stream in streams:
+            stream.on_modified = None
+            stream.detach_source()
+        self._stream_cache = OrderedDict()
+        self._live_streams = weakref.WeakValueDictionary()
+        self._modified_streams = dict()
 
     def get_bone_data_length(self):
-        return len(self.bone_data) * 100
+        return len(self.bone_data) * SkaBone.get_size()
 
     def get_variation_data_length(self):
         return len(self.variation_data) * 0
@@ -781,277 +2163,538 @@ class SkaFile:
         for bd in self.bone_data:
             bd.write(file)
 
-    def write_animation_data(self, file, animation_data_offset):
-        # structure:
-        # SkaAnimHeader[]
-        # SkaEvent[]
+    def add_bone(self, new_bone):
+        self.bone_data.append(new_bone)
 
-        count = len(self.animation_data)
-        data_start = animation_data_offset
-        
-        streams_by_start = dict()
-        streams_written = dict()
+    def get_bone_names(self):
+        return [str(bd.name) for bd in self.bone_data]
+
+    def get_bone_name_index(self):
+        '''
+        Returns dict of casefolded bone name: bone index. Built on read, and
+        rebuilt when bones are added, removed or renamed.
+        '''
+        names, index = self._bone_name_index
+        current_names = tuple(self.get_bone_names())
+        if names != current_names:
+            index = make_bone_name_index(current_names)
+            self._bone_name_index = (current_names, index)
+        return index
+
+    def get_bone_mapping(self, skm_data):
+        '''
+        Maps the SKA bones to the SKM bones of the same (case-insensitive) name.
+        Returns (mapping, unmapped_ska, unmapped_skm):
+        mapping - (N,) int32 array, the SKM bone index of each SKA bone, or -1
+        unmapped_ska - indices of the SKA bones without a matching SKM bone
+        unmapped_skm - indices of the SKM bones without a matching SKA bone
+        If SKA bone 0 has no match, it's assumed to be SKM bone 0 (and isn't listed as unmapped).
+        '''
+        skm_index = skm_data.get_bone_name_index()
+        ska_index = self.get_bone_name_index()
+        ska_names = self.get_bone_names()
+        mapping = np.fromiter((skm_index.get(name.casefold(), -1) for name in ska_names), np.int32, len(ska_names))
+        if len(mapping) and mapping[0] == -1 and skm_data.bone_count > 0:
+            mapping[0] = 0
+        unmapped_ska = np.flatnonzero(mapping == -1).tolist()
+        unmapped_skm = [skm_idx for skm_idx, name in enumerate(skm_data.get_bone_names())
+                        if name.casefold() not in ska_index]
+        return mapping, unmapped_ska, unmapped_skm
 
-        # get data headers first
-        HEADER_SIZE = SkaAnimHeader.get_size()
-        EVENT_SIZE = SkaEvent.get_size()
-        
-        headers_size = count * HEADER_SIZE
-        cur_event_offset = headers_size
-        events_size_total = 0
+    def get_ska_to_skm_bone_map(self, skm_data):
+        '''
+        get_bone_mapping() as a dict of ska bone idx: skm bone idx (-1 if unmapped)
+        '''
+        # in some ToEE models not all SKA bones are present in SKM (clothshit? buggy exporter?)
+        mapping, unmapped_ska, unmapped_skm = self.get_bone_mapping(skm_data)
+
+        skm_parent_ids = skm_data.get_bone_parent_ids()
+        for skm_idx in unmapped_skm:
+            if skm_parent_ids[skm_idx] >= 0:
+                print("SKM bone id %d not present in SKA!" % skm_idx)
+        ska_names = self.get_bone_names()
+        if ska_names and ska_names[0].casefold() not in skm_data.get_bone_name_index():
+            print("Could not find mapping of SKA bone 0 by name; will assume its matching SKM bone id is also 0.")
+        for ska_idx in unmapped_ska:
+            print("Could not find mapping of SKA bone id %d!" % ska_idx, self.bone_data[ska_idx].name)
+        return dict(enumerate(mapping.tolist()))
+
+
+def _to_vec4_array(vectors):
+    '''
+    (N,3) or (N,4) -> contiguous (N,4) float32, padding w with 0
+    '''
+    vectors = np.asarray(vectors, dtype=np.float32)
+    vectors = vectors.reshape(len(vectors), -1)
+    result = np.zeros((len(vectors), 4), np.float32)
+    result[:, :vectors.shape[1]] = vectors
+    return result
 
-        # calculate headers first
-        for i in range(0, count):
-            anim_datum = self.animation_data[i]
-
-            # set header data offset for event data
-            # assert cur_event_offset == anim_datum.header.event_offset, "hmm"
-            anim_datum.header.event_offset = cur_event_offset
-            
-            # keep track of events to be written & current offset
-            event_count = anim_datum.header.event_count
-            assert anim_datum.header.event_count == len(anim_datum.events), "mismatch in event count!"
-            events_size = event_count * EVENT_SIZE
-            events_size_total += events_size
-            cur_event_offset += events_size - HEADER_SIZE # offset is relative to current header
-
-        # calculate stream data
-        for i in range(0, count):
-            anim_datum = self.animation_data[i]
-                
-            for stream_header in anim_datum.header.stream_headers:
-                pass
-            
+class SkmFile(object):
+    '''
+    The fixed-size tables are read into columnar arrays (one row per record):
+    bone_*, material_names, vertex_* and face_*. The SkmBone/SkmMaterial/
+    SkmVertex/SkmFace objects in bone_data, material_data, vertex_data and
+    face_data are only created when first accessed; once created, they take
+    precedence over the arrays.
+    '''
+    __slots__ = ["_bone_data", "_material_data",
+                 "_vertex_data", "_face_data",
+                 "bone_flags", "bone_parent_ids", "bone_names", "bone_world_inverse",
+                 "material_names",
+                 "vertex_pos", "vertex_normal", "vertex_uv",
+                 "vertex_attachment_count", "vertex_attachment_bones", "vertex_attachment_weights",
+                 "face_material_ids", "face_vertex_ids",
+                 "_bone_name_index", "_skeleton",
+                 "_fileraw", "_mmap", "_dataidx"]
+    
+    def __init__(self):
+        self._bone_data = []
+        self._material_data = []
+        self._vertex_data = []
+        self._face_data = []
 
-        # write the headers
-        for i in range(0, count):
-            anim_datum = self.animation_data[i]
-            anim_datum.header.write(file) # from_raw_data(self._fileraw[data_start:data_start + HEADER_SIZE])
-
-        #####################    
-        # write event data  #
-        #####################
-        # verify event data offset matches with event size total
-        assert events_size_total == cur_event_offset, "event offset mismatch"
-        for i in range(0, count):
-            anim_datum = self.animation_data[i]
-            
-            # event_offset = data_start + i * HEADER_SIZE + anim_datum.header.event_offset
+        self.bone_flags = None                # (N,) int16
+        self.bone_parent_ids = None           # (N,) int16
+        self.bone_names = None                # N str
+        self.bone_world_inverse = None        # (N,3,4) float32
 
-            for event in anim_datum.events:
-                event.write(file)
-        
-        #####################
-        # write stream data #
-        #####################
-        for stream in self.streams:
-                stream.write(file)
+        self.material_names = None            # N str
 
+        self.vertex_pos = None                # (N,4) float32
+        self.vertex_normal = None             # (N,4) float32
+        self.vertex_uv = None                 # (N,2) float32
+        self.vertex_attachment_count = None   # (N,) int16
+        self.vertex_attachment_bones = None   # (N,6) int16, unused slots zeroed
+        self.vertex_attachment_weights = None # (N,6) float32, unused slots zeroed
 
-        for i in range(0, count):
-            anim_datum = self.animation_data[i]
-            
-            # anim_datum.streams
-            for stream_header in anim_datum.header.stream_headers:
+        self.face_material_ids = None         # (N,) int16
+        self.face_vertex_ids = None           # (N,3) int16
 
-                stream_start = data_start + stream_header.data_offset
-        #         if stream_start not in streams_by_start:
-        #             stream = SkaAnimStream(anim_datum.header.name)
-        #             io = BytesIO(self._fileraw)
-        #             io.seek(stream_start)
-        #             stream.read(io)
-        #             streams_by_start[stream_start] = stream
-        #         else:
-        #             stream = streams_by_start[stream_start]
-
-        #         stream.instances.append(SkaAnimStreamInstance(
-        #             str(anim_datum.header.name),
-        #             stream_header.frame_rate,
-        #             stream_header.dps
-        #         ))
-        #         anim_datum.streams.append(stream)
-
-        #     data_start += HEADER_SIZE
-
-        # self.streams = streams_by_start.values()
+        # (bone names, index) - see get_bone_name_index
+        self._bone_name_index = ((), dict())
+        # (bone count, Skeleton) - see skeleton.get_skeleton
+        self._skeleton = (-1, None)
 
-        return
+        self._fileraw = b""
+        self._mmap = None
 
-    def add_bone(self, new_bone):
-        self.bone_data.append(new_bone)
+    @property
+    def bone_data(self):
+        if self._bone_data is None:
+            self._bone_data = self.get_bone_objects()
+        return self._bone_data
 
-    def get_ska_to_skm_bone_map(self, skm_data):
-        ska_data = self
-        ska_to_skm_bone_mapping = {}  # in some ToEE models not all SKA bones are present in SKM (clothshit? buggy exporter?)
-
-        for skm_idx, skm_bd in enumerate(skm_data.bone_data):
-
-            found  = False
-            for ska_idx, ska_bd in enumerate(ska_data.bone_data):
-                if str(ska_bd.name).lower() == str(skm_bd.name).lower():
-                    ska_to_skm_bone_mapping[ska_idx] = skm_idx
-                    found = True
-                    break
-            if not found and skm_bd.parent_id >= 0:
-                print('ho there!')
-                ska_to_skm_bone_mapping[ska_idx]
-
-
-        for ska_idx, ska_bd in enumerate(ska_data.bone_data):
-            found = False
-            for skm_idx, skm_bd in enumerate(skm_data.bone_data):
-                if str(ska_bd.name).lower() == str(skm_bd.name).lower():
-                    ska_to_skm_bone_mapping[ska_idx] = skm_idx
-                    found = True
-                    break
-            if not found and ska_idx == 0:
-                print("Could not find mapping of SKA bone 0 by name; will assume its matching SKM bone id is also 0.")
-                ska_to_skm_bone_mapping[ska_idx] = 0
-            elif not found:
-                ska_to_skm_bone_mapping[ska_idx] = -1
-                print("Could not find mapping of SKA bone id %d!" % ska_idx, ska_data.bone_data[ska_idx].name)
-        return ska_to_skm_bone_mapping
+    @bone_data.setter
+    def bone_data(self, value):
+        self._bone_data = value
+        self._bone_name_index = (None, dict())
+        self._skeleton = (-1, None)
 
+    @property
+    def material_data(self):
+        if self._material_data is None:
+            self._material_data = self.get_material_objects()
+        return self._material_data
 
-class SkmFile(object):
-    __slots__ = ["bone_data", "material_data",
-                 "vertex_data", "face_data",
-                 "_fileraw", "_dataidx"]
-    bone_data: List[SkmBone]
-    material_data: List[SkmMaterial]
-    vertex_data: List[SkmVertex]
-    face_data: List[SkmFace]
-    
-    def __init__(self):
-        self.bone_data = []
-        self.material_data = []
-        self.vertex_data = []
-        self.face_data = []
+    @material_data.setter
+    def material_data(self, value):
+        self._material_data = value
+
+    @property
+    def vertex_data(self):
+        if self._vertex_data is None:
+            self._vertex_data = self.get_vertex_objects()
+        return self._vertex_data
 
-    def read(self, file):
-        self._fileraw = file.read()
+    @vertex_data.setter
+    def vertex_data(self, value):
+        self._vertex_data = value
+
+    @property
+    def face_data(self):
+        if self._face_data is None:
+            self._face_data = self.get_face_objects()
+        return self._face_data
+
+    @face_data.setter
+    def face_data(self, value):
+        self._face_data = value
+
+    @property
+    def bone_count(self):
+        if self._bone_data is None:
+            return len(self.bone_names)
+        return len(self._bone_data)
+
+    @property
+    def material_count(self):
+        if self._material_data is None:
+            return len(self.material_names)
+        return len(self._material_data)
+
+    @property
+    def vertex_count(self):
+        if self._vertex_data is None:
+            return len(self.vertex_pos)
+        return len(self._vertex_data)
+
+    @property
+    def face_count(self):
+        if self._face_data is None:
+            return len(self.face_vertex_ids)
+        return len(self._face_data)
+
+    def read(self, file, use_mmap=False):
+        '''
+        use_mmap - memory-map the file instead of reading it into memory
+        '''
+        self._mmap, self._fileraw = open_file_buffer(file, use_mmap)
         self.get_bone_data()
         self.get_material_data()
         self.get_vertex_data()
         self.get_face_data()
+        if use_mmap:
+            self.close()
+
+    def close(self):
+        '''
+        Releases the file buffer (and memory mapping) held since read()
+        '''
+        close_file_buffer(self._mmap, self._fileraw)
+        self._mmap = None
+        self._fileraw = b""
 
     # methods for converting raw binary to basic model data
     def get_face_data(self):
-        count = struct.unpack('<i', self._fileraw[24:28])[0]
-        offset = struct.unpack('<i', self._fileraw[28:32])[0]
+        count = SKM_FILE_HEADER_SCHEMA.get(self._fileraw, "face_count")
+        offset = SKM_FILE_HEADER_SCHEMA.get(self._fileraw, "face_offset")
         print(count, 'faces, offset: ', offset)
-        DATUM_SIZE = SkmFace.get_size()
-        for i in range(0, count):
-            data_start = offset + DATUM_SIZE * i
-            newDatum = SkmFace()
-            newDatum.from_raw_data(self._fileraw[data_start:data_start + DATUM_SIZE])
-            self.face_data.append(newDatum)
+
+        raw = SKM_FACE_SCHEMA.frombuffer(self._fileraw, count, offset)
+        self.face_material_ids = raw["material_id"].copy()
+        self.face_vertex_ids = raw["vertex_ids"].copy()
+        self._face_data = None
+
+    def set_face_arrays(self, vertex_ids, material_ids=None):
+        '''
+        Sets the faces from arrays, replacing face_data. They're written to
+        file straight from the arrays.
+        vertex_ids - (N,3)
+        material_ids - (N,); all 0 if omitted
+        '''
+        vertex_ids = np.asarray(vertex_ids).reshape(-1, 3)
+        if vertex_ids.size and (vertex_ids.min() < 0 or vertex_ids.max() > 32767):
+            raise Exception("SkmFile: face vertex ids must be within 0..32767!")
+        self.face_vertex_ids = vertex_ids.astype(np.int16)
+        if material_ids is None:
+            self.face_material_ids = np.zeros(len(vertex_ids), np.int16)
+        else:
+            self.face_material_ids = np.asarray(material_ids, dtype=np.int16).reshape(len(vertex_ids))
+        self._face_data = None
+
+    def get_face_objects(self):
+        '''
+        Creates SkmFace objects from the columnar face arrays
+        '''
+        faces = []
+        if self.face_vertex_ids is None:
+            return faces
+        for material_id, vertex_ids in zip(self.face_material_ids.tolist(), self.face_vertex_ids.tolist()):
+            face = SkmFace()
+            face.material_id = material_id
+            face.vertex_ids = vertex_ids
+            faces.append(face)
+        return faces
 
     def get_vertex_data(self):
-        count = struct.unpack('<i', self._fileraw[16:20])[0]
-        offset = struct.unpack('<i', self._fileraw[20:24])[0]
+        count = SKM_FILE_HEADER_SCHEMA.get(self._fileraw, "vertex_count")
+        offset = SKM_FILE_HEADER_SCHEMA.get(self._fileraw, "vertex_offset")
         print(count, 'vertices, offset: ', offset)
 
-        DATUM_SIZE = SkmVertex.get_size()
-        for i in range(0, count):
-            data_start = offset + DATUM_SIZE * i
-            newDatum = SkmVertex()
-            newDatum.from_raw_data(self._fileraw[data_start:data_start + DATUM_SIZE])
-            self.vertex_data.append(newDatum)
+        raw = SKM_VERTEX_SCHEMA.frombuffer(self._fileraw, count, offset)
+        attachment_count = raw["attachment_count"]
+        if (attachment_count > 6).any():
+            raise Exception("SkmVertex: Unexcepted number of attachments read!")
+        attachment_count = np.clip(attachment_count, 0, 6)
+        unused = np.arange(6) >= attachment_count[:, None]
+
+        self.vertex_pos = raw["pos"].copy()
+        self.vertex_normal = raw["normal"].copy()
+        self.vertex_uv = raw["uv"].copy()
+        self.vertex_attachment_count = attachment_count
+        self.vertex_attachment_bones = raw["attachment_bones"].copy()
+        self.vertex_attachment_bones[unused] = 0
+        self.vertex_attachment_weights = raw["attachment_weights"].copy()
+        self.vertex_attachment_weights[unused] = 0.0
+        self._vertex_data = None
+
+    def set_vertex_arrays(self, pos, normal, uv, attachment_bones=None, attachment_weights=None, attachment_count=None):
+        '''
+        Sets the vertices from arrays, replacing vertex_data. They're written to
+        file straight from the arrays.
+        pos, normal - (N,3) or (N,4)
+        uv - (N,2)
+        attachment_bones, attachment_weights, attachment_count - see set_vertex_attachments
+        '''
+        vertex_count = len(pos)
+        self.vertex_pos = _to_vec4_array(pos)
+        self.vertex_normal = _to_vec4_array(normal)
+        self.vertex_uv = np.ascontiguousarray(uv, dtype=np.float32).reshape(vertex_count, 2)
+        if attachment_bones is None:
+            self.vertex_attachment_count = np.zeros(vertex_count, np.int16)
+            self.vertex_attachment_bones = np.zeros((vertex_count, 6), np.int16)
+            self.vertex_attachment_weights = np.zeros((vertex_count, 6), np.float32)
+        else:
+            self.set_vertex_attachments(attachment_bones, attachment_weights, attachment_count)
+        self._vertex_data = None
+
+    def set_vertex_attachments(self, attachment_bones, attachment_weights, attachment_count=None):
+        '''
+        Sets the vertex bone attachments from arrays (after set_vertex_arrays)
+        attachment_bones - (N,k) bone ids, k <= 6
+        attachment_weights - (N,k)
+        attachment_count - (N,); if omitted, each vertex uses its leading non-zero weights
+        '''
+        attachment_bones = np.asarray(attachment_bones)
+        attachment_weights = np.asarray(attachment_weights)
+        vertex_count, max_attachments = attachment_bones.shape
+        if max_attachments > 6:
+            raise Exception("SkmFile: too many bone attachments per vertex! Max is 6")
+        if attachment_count is None:
+            attachment_count = np.cumprod(attachment_weights != 0, axis=1).sum(axis=1)
+        attachment_count = np.asarray(attachment_count, dtype=np.int16)
+        unused = np.arange(max_attachments) >= attachment_count[:, None]
+
+        self.vertex_attachment_count = attachment_count
+        self.vertex_attachment_bones = np.zeros((vertex_count, 6), np.int16)
+        self.vertex_attachment_bones[:, :max_attachments] = np.where(unused, 0, attachment_bones)
+        self.vertex_attachment_weights = np.zeros((vertex_count, 6), np.float32)
+        self.vertex_attachment_weights[:, :max_attachments] = np.where(unused, 0.0, attachment_weights)
+        self._vertex_data = None
+
+    def get_vertex_skin_data(self):
+        '''
+        Returns (pos (N,3), normal (N,3), attachment_bones (N,6), attachment_weights (N,6))
+        arrays, unused attachment slots zeroed
+        '''
+        if self._vertex_data is None:
+            return (self.vertex_pos[:, 0:3], self.vertex_normal[:, 0:3],
+                    self.vertex_attachment_bones, self.vertex_attachment_weights)
+        vertex_count = len(self._vertex_data)
+        pos = np.array([vtx.pos[0:3] for vtx in self._vertex_data], np.float32).reshape(vertex_count, 3)
+        normal = np.array([vtx.normal[0:3] for vtx in self._vertex_data], np.float32).reshape(vertex_count, 3)
+        bones = np.zeros((vertex_count, 6), np.int16)
+        weights = np.zeros((vertex_count, 6), np.float32)
+        for i, vtx in enumerate(self._vertex_data):
+            bones[i, 0:vtx.attachment_count] = vtx.attachment_bones
+            weights[i, 0:vtx.attachment_count] = vtx.attachment_weights
+        return pos, normal, bones, weights
+
+    def get_vertex_objects(self):
+        '''
+        Creates SkmVertex objects from the columnar vertex arrays
+        '''
+        vertices = []
+        if self.vertex_pos is None:
+            return vertices
+        columns = zip(self.vertex_pos.tolist(), self.vertex_normal.tolist(), self.vertex_uv.tolist(),
+                      self.vertex_attachment_count.tolist(),
+                      self.vertex_attachment_bones.tolist(), self.vertex_attachment_weights.tolist())
+        for pos, normal, uv, attachment_count, bones, weights in columns:
+            vtx = SkmVertex()
+            vtx.pos = pos
+            vtx.normal = normal
+            vtx.uv = uv
+            vtx.attachment_bones = bones[:attachment_count]
+            vtx.attachment_weights = weights[:attachment_count]
+            vertices.append(vtx)
+        return vertices
 
     def get_material_data(self):
-        self.material_data = []
-        count = struct.unpack('<i', self._fileraw[8:12])[0]
-        offset = struct.unpack('<i', self._fileraw[12:16])[0]
+        count = SKM_FILE_HEADER_SCHEMA.get(self._fileraw, "material_count")
+        offset = SKM_FILE_HEADER_SCHEMA.get(self._fileraw, "material_offset")
         print(count, 'materials, offset: ', offset)
 
-        DATUM_SIZE = SkmMaterial.get_size()
-        for i in range(0, count):
-            data_start = offset + DATUM_SIZE * i
-            newDatum = SkmMaterial()
-            newDatum.from_raw_data(self._fileraw[data_start:data_start + DATUM_SIZE])
-            self.material_data.append(newDatum)
-    
-    def write_bones(self, file):
-        for bd in self.bone_data:
-            bd.write(file)
-        return
-
-    def write_materials(self, file):
-        for skm_mat in self.material_data:
-            skm_mat.write(file)
-        return
-    
-    def write_vertices(self,file):
-        for vertex in self.vertex_data:
-            vertex.write(file)
-        return
+        raw = SKM_MATERIAL_SCHEMA.frombuffer(self._fileraw, count, offset)
+        self.material_names = [name.split(b'\0', 1)[0].decode() for name in raw["id"].tolist()]
+        self._material_data = None
+
+    def get_material_objects(self):
+        '''
+        Creates SkmMaterial objects from the decoded material names
+        '''
+        if self.material_names is None:
+            return []
+        return [SkmMaterial(name) for name in self.material_names]
     
-    def write_faces(self, file):
-        for face in self.face_data:
-            face.write(file)
-        return
+    # methods for packing model data into the output buffer (see to_bytes)
+    def pack_bones(self, buf, offset):
+        if self._bone_data is None:
+            table = SKM_BONE_SCHEMA.frombuffer(buf, self.bone_count, offset)
+            table["flags"] = self.bone_flags
+            table["parent_id"] = self.bone_parent_ids
+            name_size = SKM_BONE_SCHEMA.dtype["name"].itemsize
+            table["name"] = [encode_fixed_name(name, name_size) for name in self.bone_names]
+            table["world_inverse"] = self.bone_world_inverse
+            return
+        DATUM_SIZE = SkmBone.get_size()
+        for i, bd in enumerate(self._bone_data):
+            bd.pack_into(buf, offset + i * DATUM_SIZE)
+
+    def pack_materials(self, buf, offset):
+        if self._material_data is None:
+            table = SKM_MATERIAL_SCHEMA.frombuffer(buf, self.material_count, offset)
+            name_size = SKM_MATERIAL_SCHEMA.dtype["id"].itemsize
+            table["id"] = [encode_fixed_name(name, name_size) for name in self.material_names]
+            return
+        DATUM_SIZE = SkmMaterial.get_size()
+        for i, skm_mat in enumerate(self._material_data):
+            skm_mat.pack_into(buf, offset + i * DATUM_SIZE)
+
+    def pack_vertices(self, buf, offset):
+        if self._vertex_data is None:
+            table = SKM_VERTEX_SCHEMA.frombuffer(buf, self.vertex_count, offset)
+            table["pos"] = self.vertex_pos
+            table["normal"] = self.vertex_normal
+            table["uv"] = self.vertex_uv
+            table["attachment_count"] = self.vertex_attachment_count
+            table["attachment_bones"] = self.vertex_attachment_bones
+            table["attachment_weights"] = self.vertex_attachment_weights
+            return
+        DATUM_SIZE = SkmVertex.get_size()
+        for i, vertex in enumerate(self._vertex_data):
+            vertex.pack_into(buf, offset + i * DATUM_SIZE)
+
+    def pack_faces(self, buf, offset):
+        if self._face_data is None:
+            table = SKM_FACE_SCHEMA.frombuffer(buf, self.face_count, offset)
+            table["material_id"] = self.face_material_ids
+            table["vertex_ids"] = self.face_vertex_ids
+            return
+        DATUM_SIZE = SkmFace.get_size()
+        for i, face in enumerate(self._face_data):
+            face.pack_into(buf, offset + i * DATUM_SIZE)
 
     def get_bone_data(self):
-        bone_count = struct.unpack('<i', self._fileraw[0:4])[0]
-        bone_offset = struct.unpack('<i', self._fileraw[4:8])[0]
+        bone_count = SKM_FILE_HEADER_SCHEMA.get(self._fileraw, "bone_count")
+        bone_offset = SKM_FILE_HEADER_SCHEMA.get(self._fileraw, "bone_offset")
         print(bone_count, 'bones, offset: ', bone_offset)
 
-        DATUM_SIZE = SkmBone.get_size()
-        for i in range(0, bone_count):
-            bone_start = bone_offset + DATUM_SIZE * i
-            newbone = SkmBone()
-            newbone.from_raw_data(self._fileraw[bone_start:bone_start + DATUM_SIZE])
-            self.bone_data.append(newbone)
+        raw = SKM_BONE_SCHEMA.frombuffer(self._fileraw, bone_count, bone_offset)
+        self.bone_flags = raw["flags"].copy()
+        self.bone_parent_ids = raw["parent_id"].copy()
+        self.bone_names = [name.split(b'\0', 1)[0].decode() for name in raw["name"].tolist()]
+        self.bone_world_inverse = raw["world_inverse"].copy()
+        self._bone_data = None
+        self.get_bone_name_index()
+
+    def get_bone_names(self):
+        if self._bone_data is None:
+            return list(self.bone_names)
+        return [str(bd.name) for bd in self._bone_data]
+
+    def get_bone_parent_ids(self):
+        if self._bone_data is None:
+            return self.bone_parent_ids.tolist()
+        return [bd.parent_id for bd in self._bone_data]
+
+    def get_bone_world_inverse(self):
+        '''
+        Returns the bones' world inverse matrices as an (N,3,4) array
+        '''
+        if self._bone_data is None:
+            return self.bone_world_inverse
+        return np.array([bd.world_inverse for bd in self._bone_data], dtype=np.float32).reshape(-1, 3, 4)
+
+    def get_bone_name_index(self):
+        '''
+        Returns dict of casefolded bone name: bone index. Built on read, and
+        rebuilt when bones are added, removed or renamed.
+        '''
+        names, index = self._bone_name_index
+        current_names = tuple(self.get_bone_names())
+        if names != current_names:
+            index = make_bone_name_index(current_names)
+            self._bone_name_index = (current_names, index)
+        return index
+
+    def get_bone_objects(self):
+        '''
+        Creates SkmBone objects from the columnar bone arrays
+        '''
+        bones = []
+        if self.bone_names is None:
+            return bones
+        columns = zip(self.bone_flags.tolist(), self.bone_parent_ids.tolist(), self.bone_names,
+                      self.bone_world_inverse.tolist())
+        for flags, parent_id, name, world_inverse in columns:
+            bone = SkmBone(name, parent_id)
+            bone.flags = flags
+            bone.world_inverse = world_inverse
+            bones.append(bone)
+        return bones
 
     def write(self, file):
-        BONE_DATA_OFFSET = 40  # always 24
-        
-        # first write the header
+        time1 = time.perf_counter()
+        data = self.to_bytes()
+        file.write(data)
+        elapsed = time.perf_counter() - time1
+        print("%d bytes written in %.3f sec (%.1f MB/s)" % (len(data), elapsed, len(data) / 2**20 / max(elapsed, 1e-9)))
+
+    def to_bytes(self):
+        '''
+        Serializes the model into a single buffer of the exact file size
+        '''
+        BONE_DATA_OFFSET = SKM_FILE_HEADER_SCHEMA.size  # always 40
+
+        # first compute the header
 
         # bone header data
-        bone_count = len(self.bone_data)
-        file.write(struct.pack("<2i", bone_count, BONE_DATA_OFFSET)) # 0:8
+        bone_count = self.bone_count
         bone_data_size = self.get_bone_data_length()
         
         # material header data
-        material_count = len(self.material_data)
+        material_count = self.material_count
         material_data_offset = BONE_DATA_OFFSET + bone_data_size
-        file.write(struct.pack("<2i", material_count, material_data_offset)) # 8:16
         material_data_size = self.get_material_data_length()
 
         # vertex header data
-        vertex_count = len(self.vertex_data)
+        vertex_count = self.vertex_count
         vertex_data_offset = material_data_offset + material_data_size
-        file.write(struct.pack("<2i", vertex_count, vertex_data_offset)) # 16:24
         vertex_data_size = self.get_vertex_data_length()
         
         # face header data
-        face_count = len(self.face_data)
+        face_count = self.face_count
         face_data_offset = vertex_data_offset + vertex_data_size
-        file.write(struct.pack("<2i", face_count, face_data_offset)) # 24:32
         face_data_size = self.get_face_data_length()
 
-        # write some more dummy stuff I guess
-        file.write(struct.pack("<2i", 0, 0)) # 32:40
-
-        # *** write data ***
-        self.write_bones(file)
-        self.write_materials(file)
-        self.write_vertices(file)
-        self.write_faces(file)
+        buf = bytearray(face_data_offset + face_data_size)
+        SKM_FILE_HEADER_SCHEMA.pack_into(buf, 0,
+                                         bone_count, BONE_DATA_OFFSET,             # 0:8
+                                         material_count, material_data_offset,     # 8:16
+                                         vertex_count, vertex_data_offset,         # 16:24
+                                         face_count, face_data_offset,             # 24:32
+                                         0, 0)                                     # 32:40 - some more dummy stuff I guess
+
+        # *** pack data ***
+        self.pack_bones(buf, BONE_DATA_OFFSET)
+        self.pack_materials(buf, material_data_offset)
+        self.pack_vertices(buf, vertex_data_offset)
+        self.pack_faces(buf, face_data_offset)
+        return buf
 
     def get_bone_data_length(self):
-        return len(self.bone_data) * SkmBone.get_size()
+        return self.bone_count * SkmBone.get_size()
 
     def get_material_data_length(self):
-        return len(self.material_data) * SkmMaterial.get_size()
+        return self.material_count * SkmMaterial.get_size()
 
     def get_vertex_data_length(self):
-        return len(self.vertex_data) * SkmVertex.get_size()
+        return self.vertex_count * SkmVertex.get_size()
 
     def get_face_data_length(self):
-        return len(self.face_data) * SkmFace.get_size()    
+        return self.face_count * SkmFace.get_size()
 
 
     def add_bone(self, new_bone):
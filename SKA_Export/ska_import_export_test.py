@@ -3,7 +3,7 @@ import os
 
 
 def main():
-    from ska import SkmFile, SkaFile    
+    from ska import SkmFile, SkaFile, DECODE_RAW_FRAMES
     skm_data = SkmFile()
     # filepath = 'D:/GOG Games/ToEECo8/data/art/meshes/Monsters/Giants/Hill_Giants/Hill_Giant_2/Zomb_giant_2.SKA'
     filepath = r'D:\GOG Games\Vanilla Files\art\meshes\Monsters\Icelizard\icelizard.SKA'
@@ -20,7 +20,7 @@ def main():
     ska_data = SkaFile()
     file = open(ska_filepath, 'rb')
     print('Opened file: ', ska_filepath)
-    ska_data.read(file)
+    ska_data.read(file, decode_mode=DECODE_RAW_FRAMES)
 
     print(str(len(ska_data.streams)) + " Streams")
     print(str(len(ska_data.animation_data)) + " Anims")
@@ -0,0 +1,244 @@
+import time
+
+import numpy as np
+
+try:
+    from .ska import SkaChannelArrays
+    from .ska_pose import nlerp_quaternions
+except ImportError:
+    from ska import SkaChannelArrays
+    from ska_pose import nlerp_quaternions
+
+
+########
+# Keyframe reduction
+########
+# A key can be dropped if interpolating linearly between the keys around it
+# (nlerp for rotations, as SkaPoseEvaluator plays them back) reproduces every
+# original key in between within tolerance.
+
+ANGULAR_TOLERANCE = 0.001  # radians
+DISTANCE_TOLERANCE = 0.01  # location units
+
+
+def _interpolation_errors(frames, values, a, b, j, rotation):
+    '''
+    Error at keys j when interpolating between keys a and b (flat key indices)
+    '''
+    t = ((frames[j] - frames[a]) / (frames[b] - frames[a]))[:, None]
+    if not rotation:
+        return np.linalg.norm(values[a] + (values[b] - values[a]) * t - values[j], axis=1)
+
+    q = nlerp_quaternions(values[a], values[b], t)
+    # a zero key can't be reproduced (error pi), so it stays
+    norm = np.linalg.norm(values[j], axis=1)[:, None]
+    qj = values[j] / np.where(norm > 0, norm, 1.0)
+    return 2 * np.arccos(np.clip(np.abs(np.sum(q * qj, axis=1)), 0.0, 1.0))
+
+
+def _span_errors(frames, values, a, b, rotation):
+    '''
+    Interpolates over each span (a[i], b[i]) and returns (j, errors, span_starts):
+    the keys strictly inside the spans, their errors, and where each span's
+    keys start in j
+    '''
+    counts = b - a - 1
+    span_starts = np.cumsum(counts) - counts
+    span = np.repeat(np.arange(len(a)), counts)
+    j = a[span] + 1 + (np.arange(int(counts.sum())) - span_starts[span])
+    return j, _interpolation_errors(frames, values, a[span], b[span], j, rotation), span_starts
+
+
+def _reduce_channel(arrays, tolerance, rotation):
+    '''
+    Returns (keep, key_errors): which keys of the channel to keep, and the
+    error at each key once the others are dropped
+    '''
+    key_count = len(arrays.frames)
+    frames = arrays.frames.astype(np.float64)
+    values = arrays.values.astype(np.float64)
+    key_rows = np.repeat(np.arange(len(arrays.bone_ids)), np.diff(arrays.offsets))
+    keep = np.ones(key_count, bool)
+
+    while True:
+        kept = np.flatnonzero(keep)
+        rows = key_rows[kept]
+        # a bone's first and last keys always stay
+        interior = np.zeros(len(kept), bool)
+        interior[1:-1] = (rows[:-2] == rows[1:-1]) & (rows[2:] == rows[1:-1])
+        candidates = np.flatnonzero(interior)
+        if len(candidates) == 0:
+            break
+
+        _, errors, span_starts = _span_errors(frames, values, kept[candidates - 1], kept[candidates + 1], rotation)
+        removable = np.zeros(len(kept), bool)
+        removable[candidates] = np.maximum.reduceat(errors, span_starts) <= tolerance
+        if not removable.any():
+            break
+
+        # neighbouring keys can't both go in the same round; drop every other one of each run
+        run_start = removable & ~np.concatenate(([False], removable[:-1]))
+        run_start_pos = np.flatnonzero(run_start)
+        run_idx = np.maximum(np.cumsum(run_start) - 1, 0)
+        keep[kept[removable & ((np.arange(len(kept)) - run_start_pos[run_idx]) % 2 == 0)]] = False
+
+    key_errors = np.zeros(key_count)
+    kept = np.flatnonzero(keep)
+    same_bone = key_rows[kept[:-1]] == key_rows[kept[1:]]
+    j, errors, _ = _span_errors(frames, values, kept[:-1][same_bone], kept[1:][same_bone], rotation)
+    key_errors[j] = errors
+    return keep, key_errors
+
+
+def _filter_keys(arrays, keep):
+    key_rows = np.repeat(np.arange(len(arrays.bone_ids)), np.diff(arrays.offsets))
+    offsets = np.zeros(len(arrays.bone_ids) + 1, np.int32)
+    np.cumsum(np.bincount(key_rows[keep], minlength=len(arrays.bone_ids)), out=offsets[1:])
+    return SkaChannelArrays(arrays.width, arrays.bone_ids.copy(), offsets, arrays.frames[keep], arrays.values[keep])
+
+
+def reduce_stream_keys(stream, angular_tolerance=ANGULAR_TOLERANCE, distance_tolerance=DISTANCE_TOLERANCE,
+                       scale_tolerance=None):
+    '''
+    Drops the keys of a SkaAnimStream that interpolation reproduces within tolerance.
+    angular_tolerance - max. rotation error, radians
+    distance_tolerance - max. location error
+    scale_tolerance - max. scale error; same as distance_tolerance if None
+
+    Returns dict of bone_idx: [keys before, keys after, max. rotation error,
+    max. location error, max. scale error]
+    '''
+    if scale_tolerance is None:
+        scale_tolerance = distance_tolerance
+
+    stats = dict()
+    channels = (("scale_arrays", scale_tolerance, False, 4),
+                ("rotation_arrays", angular_tolerance, True, 2),
+                ("location_arrays", distance_tolerance, False, 3))
+    for attr, tolerance, rotation, error_column in channels:
+        arrays = getattr(stream, attr)
+        keep, key_errors = _reduce_channel(arrays, tolerance, rotation)
+
+        counts_before = np.diff(arrays.offsets)
+        key_rows = np.repeat(np.arange(len(arrays.bone_ids)), counts_before)
+        counts_after = np.bincount(key_rows[keep], minlength=len(arrays.bone_ids))
+        max_errors = np.zeros(len(arrays.bone_ids))
+        has_keys = counts_before > 0
+        if has_keys.any():
+            max_errors[has_keys] = np.maximum.reduceat(key_errors, arrays.offsets[:-1][has_keys])
+        for bone_idx, before, after, max_error in zip(arrays.bone_ids.tolist(), counts_before.tolist(),
+                                                      counts_after.tolist(), max_errors.tolist()):
+            bone_stats = stats.setdefault(bone_idx, [0, 0, 0.0, 0.0, 0.0])
+            bone_stats[0] += before
+            bone_stats[1] += after
+            bone_stats[error_column] = max_error
+
+        if not keep.all():
+            setattr(stream, attr, _filter_keys(arrays, keep))
+    return stats
+
+
+def reduce_ska_keys(ska_file, angular_tolerance=ANGULAR_TOLERANCE, distance_tolerance=DISTANCE_TOLERANCE,
+                    scale_tolerance=None, verbose=False):
+    '''
+    Runs reduce_stream_keys() on every stream of a SkaFile and reports the
+    key counts; with verbose, also the key counts and max. errors per bone.
+    Returns a list of (stream, stats).
+    '''
+    time1 = time.perf_counter()
+    result = []
+    total_before = 0
+    total_after = 0
+    for stream in ska_file.streams:
+        stats = reduce_stream_keys(stream, angular_tolerance, distance_tolerance, scale_tolerance)
+        result.append((stream, stats))
+        before = sum(bone_stats[0] for bone_stats in stats.values())
+        after = sum(bone_stats[1] for bone_stats in stats.values())
+        total_before += before
+        total_after += after
+        print("%s: %d -> %d keys" % (stream.name, before, after))
+        if verbose:
+            for bone_idx, (bone_before, bone_after, rotation_error, location_error, scale_error) in sorted(stats.items()):
+                print("  bone %d: %d -> %d keys, max. error rotation %.5f location %.5f scale %.5f"
+                      % (bone_idx, bone_before, bone_after, rotation_error, location_error, scale_error))
+    print("%d -> %d keys (%.1f%%) in %.2f sec."
+          % (total_before, total_after, 100.0 * total_after / max(total_before, 1), time.perf_counter() - time1))
+    return result
+
+
+########
+# Quantization factors
+########
+# Scales and locations are stored as int16 times scale_factor/location_factor;
+# the smallest factors that still fit a stream's keys give the most precision.
+
+def _quantization_errors(values, factor):
+    '''
+    Returns (max. error, rms error) of storing values quantized with factor
+    '''
+    if values.size == 0:
+        return 0.0, 0.0
+    values = values.astype(np.float64)
+    errors = np.abs(np.rint(values / factor) * factor - values)
+    return float(errors.max()), float(np.sqrt(np.mean(errors ** 2)))
+
+
+def _fit_factor(values, factor):
+    '''
+    Smallest (float32) factor that fits values in int16; factor if there's nothing to fit
+    '''
+    if values.size == 0:
+        return factor
+    max_abs = float(np.abs(values.astype(np.float64)).max())
+    if max_abs == 0:
+        return factor
+    new_factor = np.float32(max_abs / 32767.0)
+    # rounding to float32 mustn't push the largest value past 32767
+    while max_abs / float(new_factor) >= 32767.5:
+        new_factor = np.nextafter(new_factor, np.float32(np.inf))
+    return float(new_factor)
+
+
+def optimize_stream_factors(stream):
+    '''
+    Picks the smallest scale_factor and location_factor that fit all of a
+    SkaAnimStream's scale and location keys in int16, and re-quantizes the
+    stream with them (the raw frames get rebuilt from the channels).
+    Streams whose factors are already tight are left alone.
+
+    Returns dict of "scale"/"location": (old factor, new factor, max. error, rms error)
+    '''
+    stats = dict()
+    for name, arrays, factor in (("scale", stream.scale_arrays, stream.scale_factor),
+                                 ("location", stream.location_arrays, stream.location_factor)):
+        new_factor = _fit_factor(arrays.values, factor)
+        stats[name] = (factor, new_factor) + _quantization_errors(arrays.values, new_factor)
+
+    if any(np.float32(old) != np.float32(new) for old, new, _, _ in stats.values()):
+        stream.mark_dirty(channels=True)
+        stream.scale_factor = stats["scale"][1]
+        stream.location_factor = stats["location"][1]
+    return stats
+
+
+def optimize_ska_factors(ska_file):
+    '''
+    Runs optimize_stream_factors() on every stream of a SkaFile and reports
+    the factors and quantization errors. Returns a list of (stream, stats).
+    '''
+    time1 = time.perf_counter()
+    result = []
+    changed_count = 0
+    max_errors = {"scale": 0.0, "location": 0.0}
+    for stream in ska_file.streams:
+        stats = optimize_stream_factors(stream)
+        result.append((stream, stats))
+        for name, (old_factor, new_factor, max_error, rms_error) in stats.items():
+            max_errors[name] = max(max_errors[name], max_error)
+        if any(np.float32(old_factor) != np.float32(new_factor) for old_factor, new_factor, _, _ in stats.values()):
+            changed_count += 1
+        print("%s: scale %g -> %g (max. error %g, rms %g), location %g -> %g (max. error %g, rms %g)"
+              % ((stream.name,) + stats["scale"] + stats["location"]))
+    print("%d of %d streams re-quantized, max. error scale %g location %g in %.2f sec."
+          % (changed_count, len(result), max_errors["scale"], max_errors["location"], time.perf_counter() - time1))
+    return result
@@ -0,0 +1,176 @@
+import mmap
+import time
+
+try:
+    from .ska import SkaAnimHeader, SkaEvent, SKA_FILE_HEADER_SCHEMA, SKA_ANIM_HEADER_SCHEMA, \
+        SKA_ANIM_STREAM_HEADER_SCHEMA, SKA_EVENT_SCHEMA
+except ImportError:
+    from ska import SkaAnimHeader, SkaEvent, SKA_FILE_HEADER_SCHEMA, SKA_ANIM_HEADER_SCHEMA, \
+        SKA_ANIM_STREAM_HEADER_SCHEMA, SKA_EVENT_SCHEMA
+
+
+class SkaPatcher(object):
+    '''
+    Edits the fixed-size records of an existing SKA file (animation headers and
+    events) in place, through a writable memory mapping. Nothing else is read,
+    decoded or rewritten, so only the patched bytes change.
+
+    Animations are looked up by name, case-insensitively.
+
+        with SkaPatcher(filepath) as ska:
+            ska.set_frame_rate("unarmed_unarmed_idle", 30.0)
+            ska.set_event("unarmed_unarmed_attack", 0, action="hit")
+    '''
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.patch_count = 0  # number of fields written
+        self._file = open(filepath, 'r+b')
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_WRITE)
+        except Exception:
+            self._file.close()
+            raise
+
+        try:
+            self._read_anim_table()
+        except Exception:
+            self.close()
+            raise
+
+    def _read_anim_table(self):
+        anim_count = SKA_FILE_HEADER_SCHEMA.get(self._mmap, "anim_count")
+        anim_offset = SKA_FILE_HEADER_SCHEMA.get(self._mmap, "anim_offset")
+        HEADER_SIZE = SKA_ANIM_HEADER_SCHEMA.size
+        if anim_count < 0 or anim_offset + anim_count * HEADER_SIZE > len(self._mmap):
+            raise Exception("SkaPatcher: %s has an invalid animation table" % self.filepath)
+
+        # name -> animation header offset
+        self._anim_offsets = dict()
+        self._anim_names = []
+        for i in range(anim_count):
+            header_start = anim_offset + i * HEADER_SIZE
+            name = SKA_ANIM_HEADER_SCHEMA.get(self._mmap, "name", header_start).split(b'\0', 1)[0].decode()
+            self._anim_names.append(name)
+            self._anim_offsets.setdefault(name.casefold(), header_start)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.flush()
+            self._mmap.close()
+            self._mmap = None
+        self._file.close()
+
+    def get_anim_names(self):
+        return list(self._anim_names)
+
+    def _get_header_start(self, anim_name):
+        header_start = self._anim_offsets.get(anim_name.casefold())
+        if header_start is None:
+            raise Exception("SkaPatcher: no animation named %s in %s" % (anim_name, self.filepath))
+        return header_start
+
+    def get_anim_header(self, anim_name):
+        '''
+        Returns a (detached) SkaAnimHeader for the animation
+        '''
+        header_start = self._get_header_start(anim_name)
+        header = SkaAnimHeader()
+        header.from_raw_data(bytes(self._mmap[header_start:header_start + SKA_ANIM_HEADER_SCHEMA.size]))
+        return header
+
+    def get_events(self, anim_name):
+        '''
+        Returns the animation's events as a list of (detached) SkaEvents
+        '''
+        header_start = self._get_header_start(anim_name)
+        event_count = SKA_ANIM_HEADER_SCHEMA.get(self._mmap, "event_count", header_start)
+        event_offset = SKA_ANIM_HEADER_SCHEMA.get(self._mmap, "event_offset", header_start)
+        if event_count <= 0:
+            return []
+        event_start = header_start + event_offset
+        return SkaEvent.from_raw_data(
+            bytes(self._mmap[event_start:event_start + event_count * SKA_EVENT_SCHEMA.size]), event_count)
+
+    def _patch(self, schema, field, offset, value):
+        schema.set(self._mmap, field, value, offset)
+        self.patch_count += 1
+
+    def _patch_name(self, schema, field, offset, name):
+        b_name = name.encode()
+        size = schema.dtype[field].itemsize
+        # leave room for the NUL terminator
+        if len(b_name) >= size:
+            raise Exception("SkaPatcher: %s is too long (max. %d bytes)" % (name, size - 1))
+        self._patch(schema, field, offset, b_name)
+
+    def set_drive_type(self, anim_name, drive_type):
+        self._patch(SKA_ANIM_HEADER_SCHEMA, "drive_type", self._get_header_start(anim_name), drive_type)
+
+    def set_loopable(self, anim_name, loopable):
+        self._patch(SKA_ANIM_HEADER_SCHEMA, "loopable", self._get_header_start(anim_name), int(loopable))
+
+    def _get_stream_header_starts(self, anim_name, stream_idx):
+        header_start = self._get_header_start(anim_name)
+        stream_count = SKA_ANIM_HEADER_SCHEMA.get(self._mmap, "stream_count", header_start)
+        if stream_idx is None:
+            stream_indices = range(stream_count)
+        elif 0 <= stream_idx < stream_count:
+            stream_indices = [stream_idx]
+        else:
+            raise Exception("SkaPatcher: animation %s has no stream %d" % (anim_name, stream_idx))
+        first_stream_header = header_start + SKA_ANIM_HEADER_SCHEMA.offsets["stream_headers"]
+        return [first_stream_header + i * SKA_ANIM_STREAM_HEADER_SCHEMA.size for i in stream_indices]
+
+    def set_frame_rate(self, anim_name, frame_rate, stream_idx=None):
+        '''
+        stream_idx - index of the stream within the animation; None for all of them
+        '''
+        for stream_header_start in self._get_stream_header_starts(anim_name, stream_idx):
+            self._patch(SKA_ANIM_STREAM_HEADER_SCHEMA, "frame_rate", stream_header_start, frame_rate)
+
+    def set_dps(self, anim_name, dps, stream_idx=None):
+        '''
+        stream_idx - index of the stream within the animation; None for all of them
+        '''
+        for stream_header_start in self._get_stream_header_starts(anim_name, stream_idx):
+            self._patch(SKA_ANIM_STREAM_HEADER_SCHEMA, "dps", stream_header_start, dps)
+
+    def set_event(self, anim_name, event_idx, frame_id=None, event_type=None, action=None):
+        '''
+        Rewrites the given fields of an existing event; fields left None are kept
+        '''
+        header_start = self._get_header_start(anim_name)
+        event_count = SKA_ANIM_HEADER_SCHEMA.get(self._mmap, "event_count", header_start)
+        event_offset = SKA_ANIM_HEADER_SCHEMA.get(self._mmap, "event_offset", header_start)
+        if not 0 <= event_idx < event_count:
+            raise Exception("SkaPatcher: animation %s has no event %d" % (anim_name, event_idx))
+        event_start = header_start + event_offset + event_idx * SKA_EVENT_SCHEMA.size
+        if frame_id is not None:
+            self._patch(SKA_EVENT_SCHEMA, "frame_id", event_start, frame_id)
+        if event_type is not None:
+            self._patch_name(SKA_EVENT_SCHEMA, "type", event_start, event_type)
+        if action is not None:
+            self._patch_name(SKA_EVENT_SCHEMA, "action", event_start, action)
+
+
+def patch_ska_files(filepaths, patch):
+    '''
+    Calls patch(SkaPatcher) for each of the SKA files, e.g. to apply
+    the same metadata fix across a whole install
+    '''
+    time1 = time.perf_counter()
+    file_count = 0
+    patch_count = 0
+    for filepath in filepaths:
+        with SkaPatcher(filepath) as patcher:
+            patch(patcher)
+            patch_count += patcher.patch_count
+        file_count += 1
+    print("%d fields patched in %d files in %.2f sec." % (patch_count, file_count, time.perf_counter() - time1))
@@ -0,0 +1,162 @@
+import time
+
+import numpy as np
+
+try:
+    from .skeleton import get_skeleton, compose_transforms
+except ImportError:
+    from skeleton import get_skeleton, compose_transforms
+
+
+# frames are int16; shifted by this, (row, frame) pairs sort as a single float key
+_FRAME_BIAS = 32768
+_ROW_STRIDE = 65536 * 2
+
+BATCH_SIZE = 128  # frames per evaluation pass
+
+
+def nlerp_quaternions(q0, q1, t):
+    '''
+    Interpolates (..., 4) quaternions linearly along the shorter arc and
+    renormalizes - how rotations are played back. t broadcasts against (..., 1).
+    '''
+    q1 = np.where(np.sum(q0 * q1, axis=-1, keepdims=True) < 0, -q1, q1)
+    q = q0 + (q1 - q0) * t
+    norm = np.linalg.norm(q, axis=-1, keepdims=True)
+    return q / np.where(norm > 0, norm, 1.0)
+
+
+class _ChannelTrack(object):
+    '''
+    One channel of a stream, completed to cover every bone: bones without keys
+    get a single key holding their rest value. Keys are sorted by (bone, frame),
+    so one searchsorted finds the keys around a frame for all bones at once.
+    '''
+    __slots__ = "frames", "values", "starts", "ends", "sort_keys"
+
+    def __init__(self, arrays, rest_values):
+        bone_count = len(rest_values)
+        counts = np.zeros(bone_count, np.int64)
+        in_range = (arrays.bone_ids >= 0) & (arrays.bone_ids < bone_count)
+        key_counts = np.diff(arrays.offsets)
+        counts[arrays.bone_ids[in_range]] = key_counts[in_range]
+        has_keys = counts > 0
+        counts[~has_keys] = 1
+
+        self.ends = np.cumsum(counts)
+        self.starts = self.ends - counts
+        key_count = int(self.ends[-1]) if bone_count else 0
+        self.frames = np.zeros(key_count, np.float64)
+        self.values = np.empty((key_count, rest_values.shape[1]), np.float64)
+        self.values[self.starts[~has_keys]] = rest_values[~has_keys]
+
+        key_rows = np.repeat(np.arange(len(arrays.bone_ids)), key_counts)
+        key_bones = arrays.bone_ids[key_rows].astype(np.int64)
+        use = (key_bones >= 0) & (key_bones < bone_count)
+        # position of each key within its bone's keys
+        key_pos = np.arange(len(key_rows)) - arrays.offsets[:-1][key_rows]
+        dest = self.starts[key_bones[use]] + key_pos[use]
+        self.frames[dest] = arrays.frames[use]
+        self.values[dest] = arrays.values[use]
+
+        bones = np.repeat(np.arange(bone_count), counts)
+        self.sort_keys = bones * _ROW_STRIDE + (self.frames + _FRAME_BIAS)
+
+    def evaluate(self, frames, rotation):
+        '''
+        frames - (F,) frames -> (F, N, width) values of every bone, interpolated
+        between the surrounding keys and held before the first / after the last one
+        '''
+        queries = np.arange(len(self.starts)) * _ROW_STRIDE + (frames[:, None] + _FRAME_BIAS)
+        i0 = np.searchsorted(self.sort_keys, queries, side='right') - 1
+        i0 = np.clip(i0, self.starts, self.ends - 1)
+        i1 = np.minimum(i0 + 1, self.ends - 1)
+        f0 = self.frames[i0]
+        span = self.frames[i1] - f0
+        t = np.where(span > 0, (frames[:, None] - f0) / np.where(span > 0, span, 1.0), 0.0)
+        t = np.clip(t, 0.0, 1.0)[..., None]
+
+        v0 = self.values[i0]
+        v1 = self.values[i1]
+        if not rotation:
+            return v0 + (v1 - v0) * t
+        return nlerp_quaternions(v0, v1, t)
+
+
+class SkaPoseEvaluator(object):
+    '''
+    Evaluates the pose of a SkaAnimStream at any (fractional) frame, for all
+    bones of the SkaFile's skeleton at once, without Blender. Bones the stream
+    has no keys for stay in their rest pose.
+
+        evaluator = SkaPoseEvaluator(ska_data, ska_data.animation_data[0].streams[0])
+        local, world = evaluator.evaluate(np.arange(0, 30, 0.5))
+    '''
+
+    def __init__(self, ska_data, stream):
+        self.skeleton = get_skeleton(ska_data)
+        self.stream = stream
+        bones = ska_data.bone_data
+        rest_scales = np.array([bd.scale[0:3] for bd in bones], np.float64).reshape(-1, 3)
+        # rotations are stored x, y, z, w; the channels hold w, x, y, z
+        rest_rotations = np.array([bd.rotation for bd in bones], np.float64).reshape(-1, 4)[:, [3, 0, 1, 2]]
+        rest_locations = np.array([bd.translation[0:3] for bd in bones], np.float64).reshape(-1, 3)
+        self._scale = _ChannelTrack(stream.scale_arrays, rest_scales)
+        self._rotation = _ChannelTrack(stream.rotation_arrays, rest_rotations)
+        self._location = _ChannelTrack(stream.location_arrays, rest_locations)
+
+    def get_frame_range(self):
+        '''
+        Returns (first, last) keyed frame of the stream
+        '''
+        frames = [arrays.frames for arrays in
+                  (self.stream.scale_arrays, self.stream.rotation_arrays, self.stream.location_arrays)
+                  if len(arrays.frames)]
+        if not frames:
+            return 0, 0
+        return min(int(f.min()) for f in frames), max(int(f.max()) for f in frames)
+
+    def evaluate_channels(self, frames):
+        '''
+        frames - a frame or sequence of F frames
+        Returns (scales (F,N,3), rotations (F,N,4) w x y z, locations (F,N,3)),
+        relative to the parent bones
+        '''
+        frames = np.atleast_1d(np.asarray(frames, np.float64))
+        return (self._scale.evaluate(frames, False),
+                self._rotation.evaluate(frames, True),
+                self._location.evaluate(frames, False))
+
+    def evaluate(self, frames, batch_size=BATCH_SIZE):
+        '''
+        frames - a frame or sequence of F frames
+        batch_size - frames evaluated per pass; keeps the temporaries in cache
+        Returns (local, world): (F,N,4,4) bone to parent and bone to model space transforms
+        '''
+        frames = np.atleast_1d(np.asarray(frames, np.float64))
+        bone_count = self.skeleton.bone_count
+        local = np.empty((len(frames), bone_count, 4, 4))
+        world = np.empty_like(local)
+        for start in range(0, len(frames), batch_size):
+            batch = frames[start:start + batch_size]
+            scales, rotations, locations = self.evaluate_channels(batch)
+            batch_local = compose_transforms(locations.reshape(-1, 3), rotations.reshape(-1, 4),
+                                             scales.reshape(-1, 3)).reshape(len(batch), bone_count, 4, 4)
+            local[start:start + len(batch)] = batch_local
+            world[start:start + len(batch)] = self.skeleton.to_model_space(batch_local)
+        return local, world
+
+
+def evaluate_anim_poses(ska_data, anim_idx, frames, stream_idx=0):
+    '''
+    Evaluates a stream of an animation at the given frames and reports the
+    throughput. Returns (local, world) like SkaPoseEvaluator.evaluate()
+    '''
+    time1 = time.perf_counter()
+    anim = ska_data.animation_data[anim_idx]
+    evaluator = SkaPoseEvaluator(ska_data, anim.streams[stream_idx])
+    local, world = evaluator.evaluate(frames)
+    duration = time.perf_counter() - time1
+    print("%s: %d poses of %d bones evaluated in %.3f sec (%.0f poses/sec)"
+          % (str(anim.header.name), len(local), evaluator.skeleton.bone_count, duration, len(local) / max(duration, 1e-9)))
+    return local, world
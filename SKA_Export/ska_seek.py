@@ -0,0 +1,293 @@
+import os
+import struct
+import time
+import zlib
+
+import numpy as np
+
+try:
+    from .ska import SkaAnimStream, SkaChannelArrays, _SHORT, _SHORT3, _SHORT4, _FLOAT2
+except ImportError:
+    from ska import SkaAnimStream, SkaChannelArrays, _SHORT, _SHORT3, _SHORT4, _FLOAT2
+
+
+########
+# Seek tables
+########
+# Streams can only be decoded front to back. A seek table records checkpoints
+# every few raw frames: where the next raw frame starts, and for every bone
+# and channel the last two keys read so far. A raw frame only ever brings in
+# keys for later frames, so the keys needed for any frame past a checkpoint
+# are those two plus whatever follows; a range decode can start there.
+
+SEEK_INTERVAL = 16  # raw frames between checkpoints
+SEEK_INDEX_EXT = ".seek.npz"
+
+_CHANNEL_WIDTHS = (3, 4, 3)  # scale, rotation (x y z w, as stored), location
+_SHORT10 = struct.Struct("<10h")
+# channel, channels_used flag, value unpacker, bytes incl. the key's frame
+_CHANNEL_LAYOUT = ((0, 4, _SHORT3.unpack_from, 8), (1, 2, _SHORT4.unpack_from, 10), (2, 1, _SHORT3.unpack_from, 8))
+
+
+class SkaSeekTable(object):
+    '''
+    Checkpoints of one stream; C checkpoints, B bones (those of its frame 0):
+
+    scale_factor, location_factor - the stream's dequantization factors
+    bone_ids - (B,) int16
+    frames - (C,) int32, the last raw frame read before each checkpoint; -1 for the first
+    offsets - (C,) int64, where the next raw frame starts, relative to the stream start
+    key_frames - per channel, (C,B,2) int16 frames of the previous and last keys read; -1 if none
+    key_values - per channel, (C,B,2,width) int16 quantized values of those keys
+    '''
+    __slots__ = "scale_factor", "location_factor", "bone_ids", "frames", "offsets", "key_frames", "key_values"
+
+    def __init__(self, scale_factor, location_factor, bone_ids, frames, offsets, key_frames, key_values):
+        self.scale_factor = scale_factor
+        self.location_factor = location_factor
+        self.bone_ids = bone_ids
+        self.frames = frames
+        self.offsets = offsets
+        self.key_frames = key_frames
+        self.key_values = key_values
+
+    @property
+    def checkpoint_count(self):
+        return len(self.frames)
+
+    def find_checkpoint(self, frame):
+        '''
+        Index of the last checkpoint a decode of frames >= frame can start from
+        '''
+        return max(int(np.searchsorted(self.frames, frame, side='right')) - 1, 0)
+
+    @staticmethod
+    def build(buf, offset, interval=SEEK_INTERVAL):
+        '''
+        Scans the stream starting at offset once, without decoding it into
+        keyframe objects or channel arrays
+        '''
+        unpack_short = _SHORT.unpack_from
+        scale_factor, location_factor = _FLOAT2.unpack_from(buf, offset)
+        pos = offset + 8
+
+        # frame 0: bone_idx, scale, rotation, location
+        bone_ids = []
+        rows = dict()
+        # per channel, per bone: [previous frame, last frame], [previous values, last values]
+        state_frames = ([], [], [])
+        state_values = ([], [], [])
+        bone_idx = unpack_short(buf, pos)[0]
+        pos += 2
+        while bone_idx >= 0:
+            values = _SHORT10.unpack_from(buf, pos)
+            pos += 20
+            rows[bone_idx] = len(bone_ids)
+            bone_ids.append(bone_idx)
+            for channel, (start, end) in enumerate(((0, 3), (3, 7), (7, 10))):
+                state_frames[channel].append([-1, 0])
+                state_values[channel].append([(0,) * (end - start), values[start:end]])
+            bone_idx = unpack_short(buf, pos)[0]
+            pos += 2
+
+        checkpoint_frames = []
+        checkpoint_offsets = []
+        snapshots = ([], [], [])
+        snapshot_values = ([], [], [])
+
+        def add_checkpoint(frame, pos):
+            checkpoint_frames.append(frame)
+            checkpoint_offsets.append(pos - offset)
+            for channel in range(3):
+                snapshots[channel].append([list(s) for s in state_frames[channel]])
+                snapshot_values[channel].append([list(s) for s in state_values[channel]])
+
+        add_checkpoint(-1, pos)
+        frames_read = 0
+        hdr = unpack_short(buf, pos)[0]
+        pos += 2
+        while hdr & 1 == 0:
+            frame = hdr >> 1
+            if frame == -1:
+                break
+            hdr = unpack_short(buf, pos)[0]
+            pos += 2
+            while hdr & 1 == 1:
+                row = rows[hdr >> 4]
+                channels_used = (hdr >> 1) & 7
+                for channel, flag, unpack, size in _CHANNEL_LAYOUT:
+                    if channels_used & flag:
+                        frames = state_frames[channel][row]
+                        frames[0] = frames[1]
+                        frames[1] = unpack_short(buf, pos)[0]
+                        values = state_values[channel][row]
+                        values[0] = values[1]
+                        values[1] = unpack(buf, pos + 2)
+                        pos += size
+                hdr = unpack_short(buf, pos)[0]
+                pos += 2
+
+            frames_read += 1
+            # pos is 2 bytes into the next raw frame header
+            if frames_read % interval == 0:
+                add_checkpoint(frame, pos - 2)
+
+        bone_count = len(bone_ids)
+        key_frames = []
+        key_values = []
+        for channel, width in enumerate(_CHANNEL_WIDTHS):
+            key_frames.append(np.array(snapshots[channel], np.int16).reshape(-1, bone_count, 2))
+            key_values.append(np.array(snapshot_values[channel], np.int16).reshape(-1, bone_count, 2, width))
+        return SkaSeekTable(scale_factor, location_factor, np.array(bone_ids, np.int16),
+                            np.array(checkpoint_frames, np.int32), np.array(checkpoint_offsets, np.int64),
+                            key_frames, key_values)
+
+    def read_range(self, buf, offset, first_frame, last_frame, name=""):
+        '''
+        Decodes the keys of the stream starting at offset that frames
+        first_frame..last_frame need, starting from the nearest checkpoint.
+        Returns a SkaAnimStream with just those channel keys; it's meant for
+        evaluation (see ska_pose) and must not be written back to a file.
+        '''
+        checkpoint = self.find_checkpoint(first_frame)
+        # bone_idx: ([frames], [quantized values]), seeded with the checkpoint's keys
+        keys = ({}, {}, {})
+        for channel in range(3):
+            frames = self.key_frames[channel][checkpoint].tolist()
+            values = self.key_values[channel][checkpoint].tolist()
+            for bone_idx, (previous_frame, last_frame_read), (previous_values, last_values) in \
+                    zip(self.bone_ids.tolist(), frames, values):
+                if previous_frame >= 0:
+                    keys[channel][bone_idx] = ([previous_frame, last_frame_read], previous_values + last_values)
+                else:
+                    keys[channel][bone_idx] = ([last_frame_read], last_values)
+
+        unpack_short = _SHORT.unpack_from
+        pos = offset + int(self.offsets[checkpoint])
+        hdr = unpack_short(buf, pos)[0]
+        pos += 2
+        while hdr & 1 == 0:
+            frame = hdr >> 1
+            # a raw frame brings in keys past its frame; those read by last_frame cover the range
+            if frame == -1 or frame > last_frame:
+                break
+            hdr = unpack_short(buf, pos)[0]
+            pos += 2
+            while hdr & 1 == 1:
+                bone_idx = hdr >> 4
+                channels_used = (hdr >> 1) & 7
+                for channel, flag, unpack, size in _CHANNEL_LAYOUT:
+                    if channels_used & flag:
+                        bone_keys = keys[channel][bone_idx]
+                        bone_keys[0].append(unpack_short(buf, pos)[0])
+                        bone_keys[1].extend(unpack(buf, pos + 2))
+                        pos += size
+                hdr = unpack_short(buf, pos)[0]
+                pos += 2
+
+        stream = SkaAnimStream(name)
+        stream.scale_factor = self.scale_factor
+        stream.location_factor = self.location_factor
+        stream.scale_arrays = SkaChannelArrays.from_quantized(3, keys[0], self.scale_factor)
+        # rotations are stored x, y, z, w
+        stream.rotation_arrays = SkaChannelArrays.from_quantized(4, keys[1], 1 / 32767.0, [3, 0, 1, 2])
+        stream.location_arrays = SkaChannelArrays.from_quantized(3, keys[2], self.location_factor)
+        return stream
+
+
+########
+# Sidecar index files
+########
+
+def get_seek_index_path(ska_filepath):
+    return ska_filepath + SEEK_INDEX_EXT
+
+
+def build_seek_index(ska_data, interval=SEEK_INTERVAL):
+    '''
+    Builds the seek tables of all streams of a SkaFile read with lazy=True
+    (its file buffer must still be open). Returns dict of stream start: SkaSeekTable
+    '''
+    time1 = time.perf_counter()
+    buf = ska_data.get_file_buffer()
+    tables = {stream_start: SkaSeekTable.build(buf, stream_start, interval)
+              for stream_start in ska_data.get_stream_starts()}
+    checkpoint_count = sum(table.checkpoint_count for table in tables.values())
+    print("seek index: %d checkpoints for %d streams built in %.3f sec."
+          % (checkpoint_count, len(tables), time.perf_counter() - time1))
+    return tables
+
+
+def _get_file_checksum(buf):
+    return len(buf), zlib.crc32(buf)
+
+
+def write_seek_index(filepath, ska_data, tables):
+    '''
+    Writes the seek tables as an .npz sidecar, along with the size and CRC-32
+    of the SKA file they were built from
+    '''
+    file_size, crc = _get_file_checksum(ska_data.get_file_buffer())
+    stream_starts = sorted(tables.keys())
+    arrays = {
+        "file_check": np.array([file_size, crc], np.int64),
+        "stream_starts": np.array(stream_starts, np.int64),
+        "factors": np.array([(tables[start].scale_factor, tables[start].location_factor)
+                             for start in stream_starts], np.float32).reshape(-1, 2),
+    }
+    for i, stream_start in enumerate(stream_starts):
+        table = tables[stream_start]
+        arrays["bone_ids_%d" % i] = table.bone_ids
+        arrays["frames_%d" % i] = table.frames
+        arrays["offsets_%d" % i] = table.offsets
+        for channel in range(3):
+            arrays["key_frames_%d_%d" % (i, channel)] = table.key_frames[channel]
+            arrays["key_values_%d_%d" % (i, channel)] = table.key_values[channel]
+    with open(filepath, 'wb') as file:
+        np.savez(file, **arrays)
+
+
+def read_seek_index(filepath, ska_data):
+    '''
+    Reads an .npz sidecar written by write_seek_index. Returns dict of stream
+    start: SkaSeekTable, or None if it was built from a different SKA file.
+    '''
+    with np.load(filepath) as npz:
+        if tuple(npz["file_check"].tolist()) != _get_file_checksum(ska_data.get_file_buffer()):
+            print("seek index %s is out of date" % filepath)
+            return None
+        tables = dict()
+        factors = npz["factors"].tolist()
+        for i, stream_start in enumerate(npz["stream_starts"].tolist()):
+            tables[stream_start] = SkaSeekTable(
+                factors[i][0], factors[i][1], npz["bone_ids_%d" % i], npz["frames_%d" % i], npz["offsets_%d" % i],
+                [npz["key_frames_%d_%d" % (i, channel)] for channel in range(3)],
+                [npz["key_values_%d_%d" % (i, channel)] for channel in range(3)])
+    return tables
+
+
+def load_seek_index(ska_filepath, ska_data, interval=SEEK_INTERVAL):
+    '''
+    Returns the seek index of a SkaFile read with lazy=True from ska_filepath,
+    from its sidecar if that's up to date; otherwise builds it and (re)writes
+    the sidecar
+    '''
+    index_path = get_seek_index_path(ska_filepath)
+    if os.path.exists(index_path):
+        tables = read_seek_index(index_path, ska_data)
+        if tables is not None:
+            return tables
+    tables = build_seek_index(ska_data, interval)
+    write_seek_index(index_path, ska_data, tables)
+    return tables
+
+
+def read_anim_range(ska_data, seek_index, anim_idx, first_frame, last_frame, stream_idx=0):
+    '''
+    Decodes what frames first_frame..last_frame of an animation's stream need,
+    starting from the nearest checkpoint; see SkaSeekTable.read_range
+    '''
+    anim = ska_data.animation_data[anim_idx]
+    stream_start = anim.get_stream_starts()[stream_idx]
+    return seek_index[stream_start].read_range(ska_data.get_file_buffer(), stream_start, first_frame, last_frame,
+                                               str(anim.header.name))
@@ -0,0 +1,159 @@
+import numpy as np
+
+try:
+    from .ska import SkmFile, SkaFile
+except ImportError:
+    from ska import SkmFile, SkaFile
+
+
+def quaternions_to_matrices(quaternions):
+    '''
+    (N,4) quaternions, w x y z (normalized here) -> (N,3,3) rotation matrices
+    '''
+    q = np.asarray(quaternions, dtype=np.float64).reshape(-1, 4)
+    q = q / np.linalg.norm(q, axis=1)[:, None]
+    w, x, y, z = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    result = np.empty((len(q), 3, 3))
+    result[:, 0, 0] = 1 - 2 * (y * y + z * z)
+    result[:, 0, 1] = 2 * (x * y - z * w)
+    result[:, 0, 2] = 2 * (x * z + y * w)
+    result[:, 1, 0] = 2 * (x * y + z * w)
+    result[:, 1, 1] = 1 - 2 * (x * x + z * z)
+    result[:, 1, 2] = 2 * (y * z - x * w)
+    result[:, 2, 0] = 2 * (x * z - y * w)
+    result[:, 2, 1] = 2 * (y * z + x * w)
+    result[:, 2, 2] = 1 - 2 * (x * x + y * y)
+    return result
+
+
+def compose_transforms(locations, rotations, scales):
+    '''
+    (N,3) locations, (N,4) rotations (w x y z), (N,3) scales -> (N,4,4) matrices
+    applying scale, then rotation, then translation
+    '''
+    rotation_matrices = quaternions_to_matrices(rotations)
+    result = np.zeros((len(rotation_matrices), 4, 4))
+    result[:, :3, :3] = rotation_matrices * np.asarray(scales, dtype=np.float64).reshape(-1, 1, 3)
+    result[:, :3, 3] = locations
+    result[:, 3, 3] = 1.0
+    return result
+
+
+class Skeleton(object):
+    '''
+    Bone hierarchy and rest pose of a SKM or SKA skeleton, as arrays:
+
+    names - bone names
+    parent_ids - (N,) int32, -1 for root bones
+    depth - (N,) int32, 0 for root bones
+    order - (N,) int32 bone indices, parents before their children
+    children - list of child bone index lists
+    bind - (N,4,4) bone to model space, at rest
+    inverse_bind - (N,4,4) model to bone space, at rest
+    local_rest - (N,4,4) bone to parent space, at rest (bind for root bones)
+
+    Pass either bind or local_rest; the other transforms are derived from it.
+    '''
+    __slots__ = "names", "parent_ids", "depth", "order", "children", "bind", "inverse_bind", "local_rest"
+
+    def __init__(self, names, parent_ids, bind=None, local_rest=None):
+        self.names = list(names)
+        self.parent_ids = np.asarray(parent_ids, dtype=np.int32)
+        self.depth = _get_depths(self.parent_ids)
+        self.order = np.argsort(self.depth, kind='stable').astype(np.int32)
+        self.children = [[] for _ in self.names]
+        for bone_idx, parent_id in enumerate(self.parent_ids.tolist()):
+            if parent_id >= 0:
+                self.children[parent_id].append(bone_idx)
+
+        roots = self.parent_ids < 0
+        if bind is not None:
+            self.bind = np.asarray(bind, dtype=np.float64)
+            self.inverse_bind = np.linalg.inv(self.bind)
+            self.local_rest = self.bind.copy()
+            self.local_rest[~roots] = np.matmul(self.inverse_bind[self.parent_ids[~roots]], self.bind[~roots])
+        elif local_rest is not None:
+            self.local_rest = np.asarray(local_rest, dtype=np.float64)
+            self.bind = self.to_model_space(self.local_rest)
+            self.inverse_bind = np.linalg.inv(self.bind)
+        else:
+            raise Exception("Skeleton: needs either bind or local_rest transforms")
+
+    @property
+    def bone_count(self):
+        return len(self.names)
+
+    def to_model_space(self, local):
+        '''
+        Concatenates (..., N, 4, 4) bone to parent transforms down the hierarchy,
+        one level at a time; returns the bone to model space transforms
+        '''
+        local = np.asarray(local, dtype=np.float64)
+        result = np.empty_like(local)
+        roots = self.depth == 0
+        result[..., roots, :, :] = local[..., roots, :, :]
+        for level in range(1, int(self.depth.max(initial=0)) + 1):
+            bones = np.flatnonzero(self.depth == level)
+            result[..., bones, :, :] = np.matmul(result[..., self.parent_ids[bones], :, :], local[..., bones, :, :])
+        return result
+
+    @staticmethod
+    def from_skm(skm_data):
+        '''
+        From the SKM bones' world inverse (model to bone space) matrices
+        '''
+        world_inverse = np.asarray(skm_data.get_bone_world_inverse(), dtype=np.float64).reshape(-1, 3, 4)
+        inverse_bind = np.zeros((len(world_inverse), 4, 4))
+        inverse_bind[:, :3, :] = world_inverse
+        inverse_bind[:, 3, 3] = 1.0
+        return Skeleton(skm_data.get_bone_names(), skm_data.get_bone_parent_ids(), bind=np.linalg.inv(inverse_bind))
+
+    @staticmethod
+    def from_ska(ska_data):
+        '''
+        From the SKA bones' rest scale, rotation and translation relative to their parent
+        '''
+        bones = ska_data.bone_data
+        scales = np.array([bd.scale[0:3] for bd in bones], dtype=np.float64).reshape(-1, 3)
+        # rotations are stored x, y, z, w
+        rotations = np.array([bd.rotation for bd in bones], dtype=np.float64).reshape(-1, 4)[:, [3, 0, 1, 2]]
+        translations = np.array([bd.translation[0:3] for bd in bones], dtype=np.float64).reshape(-1, 3)
+        return Skeleton(ska_data.get_bone_names(), [bd.parent_id for bd in bones],
+                        local_rest=compose_transforms(translations, rotations, scales))
+
+
+def _get_depths(parent_ids):
+    bone_count = len(parent_ids)
+    if ((parent_ids < -1) | (parent_ids >= bone_count)).any():
+        raise Exception("Skeleton: invalid parent bone id")
+    has_parent = parent_ids >= 0
+    depth = np.zeros(bone_count, np.int32)
+    for _ in range(bone_count + 1):
+        new_depth = np.where(has_parent, depth[parent_ids] + 1, 0).astype(np.int32)
+        if (new_depth == depth).all():
+            return depth
+        depth = new_depth
+    raise Exception("Skeleton: bone hierarchy has a cycle")
+
+
+def get_skeleton(model_data, rebuild=False):
+    '''
+    Returns the Skeleton of a SkmFile or SkaFile. It's built on first use and
+    cached on the file object, and rebuilt when the number of bones changes;
+    pass rebuild=True after editing bones in place.
+    '''
+    if isinstance(model_data, SkmFile):
+        bone_count = model_data.bone_count
+    elif isinstance(model_data, SkaFile):
+        bone_count = len(model_data.bone_data)
+    else:
+        raise Exception("get_skeleton: expected a SkmFile or SkaFile")
+
+    count, skeleton = model_data._skeleton
+    if rebuild or count != bone_count:
+        if isinstance(model_data, SkmFile):
+            skeleton = Skeleton.from_skm(model_data)
+        else:
+            skeleton = Skeleton.from_ska(model_data)
+        model_data._skeleton = (bone_count, skeleton)
+    return skeleton
@@ -0,0 +1,123 @@
+import time
+
+import numpy as np
+
+try:
+    from .skeleton import get_skeleton
+    from .ska_pose import SkaPoseEvaluator
+except ImportError:
+    from skeleton import get_skeleton
+    from ska_pose import SkaPoseEvaluator
+
+
+BATCH_SIZE = 16  # frames skinned per pass
+
+
+class SkinningEngine(object):
+    '''
+    Linear blend skinning of a SkmFile's vertices on the CPU, for any number
+    of poses at once. A pose is given as (F,B,4,4) bone to model space
+    transforms in SKM bone order (see ska_pose_to_skm); the rest pose is
+    skeleton.bind.
+
+    Vertex weights are normalized; vertices without any weight stay at rest.
+    Normals go through the blended 3x3 and are renormalized.
+    '''
+
+    def __init__(self, skm_data):
+        self.skeleton = get_skeleton(skm_data)
+        pos, normal, bones, weights = skm_data.get_vertex_skin_data()
+        self.rest_positions = np.asarray(pos, np.float64)
+        self.rest_normals = np.asarray(normal, np.float64)
+        self.attachment_bones = np.asarray(bones, np.intp)
+        weights = np.asarray(weights, np.float64)
+        if len(self.attachment_bones) and ((self.attachment_bones < 0)
+                                           | (self.attachment_bones >= self.skeleton.bone_count)).any():
+            raise Exception("SkinningEngine: vertex attached to a bone that doesn't exist")
+
+        totals = weights.sum(axis=1)
+        self.unweighted = totals <= 0
+        self.attachment_weights = weights / np.where(self.unweighted, 1.0, totals)[:, None]
+        # only loop over the attachment slots some vertex uses
+        used = (self.attachment_weights != 0).any(axis=0)
+        self._slot_count = int(np.flatnonzero(used).max()) + 1 if used.any() else 0
+
+    @property
+    def vertex_count(self):
+        return len(self.rest_positions)
+
+    def get_palette(self, world):
+        '''
+        world - (F,B,4,4) bone to model space transforms
+        Returns the (F,B,3,4) skinning matrices: rest model space to posed model space
+        '''
+        world = np.asarray(world, np.float64).reshape(-1, self.skeleton.bone_count, 4, 4)
+        return np.matmul(world, self.skeleton.inverse_bind)[:, :, 0:3, :]
+
+    def deform(self, world, normals=True, batch_size=BATCH_SIZE):
+        '''
+        world - (F,B,4,4) bone to model space transforms, or (B,4,4) for a single pose
+        Returns (positions (F,V,3), normals (F,V,3) or None)
+        '''
+        palette = self.get_palette(world)
+        frame_count = len(palette)
+        positions = np.empty((frame_count, self.vertex_count, 3))
+        deformed_normals = np.empty_like(positions) if normals else None
+        for start in range(0, frame_count, batch_size):
+            batch = palette[start:start + batch_size]
+            # blend each vertex' bone matrices: gather, scale by weight, accumulate
+            blended = np.zeros((len(batch), self.vertex_count, 3, 4))
+            for slot in range(self._slot_count):
+                blended += batch[:, self.attachment_bones[:, slot]] * self.attachment_weights[None, :, slot, None, None]
+            blended[:, self.unweighted, :, 0:3] = np.eye(3)
+
+            rotation = blended[..., 0:3]
+            end = start + len(batch)
+            positions[start:end] = np.matmul(rotation, self.rest_positions[..., None])[..., 0] + blended[..., 3]
+            if normals:
+                n = np.matmul(rotation, self.rest_normals[..., None])[..., 0]
+                lengths = np.linalg.norm(n, axis=-1, keepdims=True)
+                deformed_normals[start:end] = n / np.where(lengths > 0, lengths, 1.0)
+        return positions, deformed_normals
+
+    def get_bounds(self, world):
+        '''
+        Returns the (F,2,3) min. and max. corners of the deformed mesh for each pose
+        '''
+        positions, _ = self.deform(world, normals=False)
+        if self.vertex_count == 0:
+            return np.zeros((len(positions), 2, 3))
+        return np.stack((positions.min(axis=1), positions.max(axis=1)), axis=1)
+
+
+def ska_pose_to_skm(skm_data, ska_data, ska_world):
+    '''
+    Reorders (F,N,4,4) SKA bone transforms (e.g. from SkaPoseEvaluator) into SKM
+    bone order; SKM bones the SKA doesn't have stay at their bind transform
+    '''
+    ska_world = np.asarray(ska_world, np.float64)
+    mapping, _, _ = ska_data.get_bone_mapping(skm_data)
+    bind = get_skeleton(skm_data).bind
+    skm_world = np.empty((len(ska_world),) + bind.shape)
+    skm_world[:] = bind
+    mapped = mapping >= 0
+    skm_world[:, mapping[mapped]] = ska_world[:, mapped]
+    return skm_world
+
+
+def skin_anim(skm_data, ska_data, anim_idx, frames, stream_idx=0, normals=True):
+    '''
+    Evaluates a stream of an animation at the given frames and skins the SKM
+    mesh with it, reporting the throughput. Returns (positions, normals) like
+    SkinningEngine.deform()
+    '''
+    time1 = time.perf_counter()
+    anim = ska_data.animation_data[anim_idx]
+    _, ska_world = SkaPoseEvaluator(ska_data, anim.streams[stream_idx]).evaluate(frames)
+    engine = SkinningEngine(skm_data)
+    positions, deformed_normals = engine.deform(ska_pose_to_skm(skm_data, ska_data, ska_world), normals)
+    duration = time.perf_counter() - time1
+    print("%s: %d vertices skinned for %d frames in %.3f sec (%.0f frames/sec)"
+          % (str(anim.header.name), engine.vertex_count, len(positions), duration,
+             len(positions) / max(duration, 1e-9)))
+    return positions, deformed_normals